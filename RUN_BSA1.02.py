@@ -5,25 +5,39 @@
 import sys
 import re
 import argparse
+import cProfile
+import hashlib
+import json
 import math
 import multiprocessing
 import os
+import pickle
+import pstats
 import random
+import resource
+import shutil
 import subprocess
+import threading
+import time
+import tracemalloc
 
+from bisect import bisect_left, bisect_right
 from decimal import Decimal
-from itertools import permutations
-from numpy import percentile
-
-import matplotlib
-matplotlib.use('Agg')
-from matplotlib import rcParams
-from matplotlib import pyplot as plt
+from itertools import permutations, product
+from multiprocessing import connection
+from multiprocessing.pool import ThreadPool
+import numpy as np
 
 N_CPU = multiprocessing.cpu_count()
-rcParams['font.sans-serif'] = 'Arial'
-rcParams['pdf.fonttype'] = 42
-rcParams['ps.fonttype'] = 42
+PERM_BUDGET = 2**22 # array elements per block of permutations computed together
+PLOT_QUEUE = [] # plots waiting for render_plots()
+GENOME_CACHE = {} # the GenomeIndex of the current chrom_file.txt
+PROFILE = [] # measurements of the stages profiled with -profile
+PROFILE_UNITS = {} # items processed by the stage being profiled, e.g. VCF lines
+PROGRESS_LINES = 20000 # VCF lines between checks whether progress is due
+PERM_COUNTERS = None # permutations finished by the workers, one counter per combination
+# matplotlib settings of the saved plots, applied only while saving
+PLOT_RC = {"font.sans-serif": "Arial", "pdf.fonttype": 42, "ps.fonttype": 42}
 
 PARSER = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter)
 
@@ -52,21 +66,22 @@ PARSER.add_argument("-ocon", "--control_offspring", required=False,
                     "if several crosses, insert them in order, commas,no_spaces")
 PARSER.add_argument("-mac", "--mac", required=False, default=0.95,
                     help="Major allele cutoff; "
-                    "locus will not be considered segregating if higher")
+                    "locus will not be considered segregating if higher; several "
+                    "separated by commas run each set of thresholds, see the README")
 PARSER.add_argument("-over", "--coverage_over", required=False, default=1.50,
-                    help="Maximum coverage depth as a multiple of genome-wide average")
+                    help="Maximum coverage depth as a multiple of genome-wide average, or several")
 PARSER.add_argument("-under", "--coverage_under", required=False, default=0.25,
-                    help="Minimum coverage depth as a multiple of genome-wide average")
+                    help="Minimum coverage depth as a multiple of genome-wide average, or several")
 PARSER.add_argument("-qds", "--qds", required=False, default=2,
-                    help="Mininum variant score")
+                    help="Mininum variant score, or several separated by commas")
 PARSER.add_argument("-sor", "--sor", required=False, default=3,
-                    help="Maximum strand bias score")
+                    help="Maximum strand bias score, or several")
 PARSER.add_argument("-mq", "--mps", required=False, default=50,
-                    help="Minimum mean mapping quality score")
+                    help="Minimum mean mapping quality score, or several")
 PARSER.add_argument("-mqrs", "--mqrs", required=False, default=-8,
-                    help="Minimum mean quality rank sum score")
+                    help="Minimum mean quality rank sum score, or several")
 PARSER.add_argument("-rprs", "--rprs", required=False, default=-8,
-                    help="Minimum read pos rank sum")
+                    help="Minimum read pos rank sum, or several")
 # General options for parsing the VCF file and for sliding window analysis
 PARSER.add_argument("-b", "--binsize", required=False, default=100000,
                     help="Genomic size of bins for storing VCF linermation")
@@ -94,6 +109,21 @@ PARSER.add_argument("-yminor", "--yminor", required=False, default=2,
 PARSER.add_argument("-col", "--colors", required=False,
                     default='jet',
                     help="Colors for plot")
+PARSER.add_argument("-fmt", "--plot_format", required=False, default="pdf",
+                    choices=["pdf", "svg", "png", "webp"],
+                    help="File format of the plots")
+PARSER.add_argument("-dpi", "--dpi", required=False, default=None,
+                    help="Resolution of the plots; "
+                         "defaults to 1500 for pdf and svg and 300 for png and webp")
+PARSER.add_argument("-raster", "--rasterize", required=False, action="store_true",
+                    help="Draw the lines as an image inside pdf and svg plots, "
+                         "keeping axes and labels as vectors")
+PARSER.add_argument("-tiles", "--tiles", required=False, action="store_true",
+                    help="Write the scans as tiles for zooming in a web browser")
+PARSER.add_argument("-fullres", "--full_resolution", required=False, action="store_true",
+                    help="Draw every window instead of thinning lines to the plot resolution")
+PARSER.add_argument("-noplot", "--noplot", required=False, action="store_true",
+                    help="Skip the plots, so that matplotlib is never loaded")
 PARSER.add_argument("-plot", "--plot", required=False, default=None,
                     help="Combined sel-control files separated by comma")
 PARSER.add_argument("-permplot", "--permplot", required=False, default=None,
@@ -101,8 +131,42 @@ PARSER.add_argument("-permplot", "--permplot", required=False, default=None,
 # this is for permutations
 PARSER.add_argument("-perm", "--perm", required=False, default=0,
                     help="The number of permutations to perform")
-PARSER.add_argument("-sig", "--significance", required=False, default=0.05,
-                    help="Significance cutoff for permutation test")
+PARSER.add_argument("-sig", "--significance", required=False, default="0.05",
+                    help="Significance cutoff for permutation test; "
+                         "several levels can be separated by commas, "
+                         "the first one is used for plotting")
+PARSER.add_argument("-ptol", "--perm_tolerance", required=False, default=0,
+                    help="Adaptive permutations: stop once the 95%% confidence interval "
+                         "of the critical value is within +/- this value; "
+                         "-perm then sets the maximum number of permutations")
+PARSER.add_argument("-pbatch", "--perm_batch", required=False, default=1000,
+                    help="Number of permutations run between precision checks "
+                         "and checkpoints")
+PARSER.add_argument("-savenull", "--save_null", required=False, action="store_true",
+                    help="Keep the full null distribution of every combination "
+                         "and extend it with -perm more permutations on later runs")
+PARSER.add_argument("-nulldir", "--null_dir", required=False, default=None,
+                    help="Directory for stored null distributions; "
+                         "defaults to BSA_output/null_distributions")
+PARSER.add_argument("-shards", "--shards", required=False, default=0,
+                    help="Split the permutations into this many shards "
+                         "to be run separately with -shard, then combined with -merge")
+PARSER.add_argument("-shard", "--shard", required=False, default=0,
+                    help="Run shard i (1 to the number of shards) of a sharded permutation plan")
+PARSER.add_argument("-merge", "--merge", required=False, action="store_true",
+                    help="Merge the finished shards of a sharded permutation plan")
+PARSER.add_argument("-seed", "--seed", required=False, default=None,
+                    help="Random seed for picking unpaired combinations, "
+                         "sharded permutation plans and peak bootstraps")
+PARSER.add_argument("-approx", "--approx", required=False, action="store_true",
+                    help="Fast approximate cutoffs from permutations evaluated on "
+                         "one window per window width")
+PARSER.add_argument("-approxcal", "--approx_calibration", required=False, default=200,
+                    help="Number of full-resolution permutations used to calibrate -approx")
+PARSER.add_argument("-sketch", "--sketch", required=False, default=0,
+                    help="Keep permutation maxima in a fixed-memory quantile sketch "
+                         "with this resolution, e.g. 0.0001; cutoffs are then within "
+                         "half the resolution of the exact values")
 PARSER.add_argument("-sigcol", "--sigcolor", required=False, default="red",
                     help="Color of line denoting significance on plot")
 PARSER.add_argument("-u", "--unpaired", required=False, action="store_true",
@@ -110,7 +174,7 @@ PARSER.add_argument("-u", "--unpaired", required=False, action="store_true",
                     "by default the are paired")
 PARSER.add_argument("-n", "--n_threads", required=False, default=N_CPU,
                     help="Number of threads; "
-                         "only used when data are unpaired; "
+                         "used for unpaired permutations, bootstraps and plotting; "
                          "defaults to the number of processing core")
 PARSER.add_argument("-comb", "--combinations", required=False, default=1,
                     help="Number of exp-control combinations "
@@ -120,12 +184,49 @@ PARSER.add_argument("-comb", "--combinations", required=False, default=1,
                          "if unpaired and any number above 1"
                          "it will use that number")
 # additional options
+PARSER.add_argument("-boot", "--bootstrap", required=False, default=0,
+                    help="Number of bootstrap resamples for the confidence interval "
+                         "of the position of each peak above the permutation cutoff")
+PARSER.add_argument("-bootby", "--bootstrap_by", required=False, default="snps",
+                    choices=["snps", "reps"],
+                    help="Resample SNPs in the peak region or selected-control replicates")
+PARSER.add_argument("-peaks", "--peaks", required=False, action="store_true",
+                    help="Call peaks above the cutoff and write them to BSA_output/peaks.bed")
+PARSER.add_argument("-peakcut", "--peak_cutoff", required=False, default=None,
+                    help="Cutoff for calling peaks; defaults to the permutation cutoff")
+PARSER.add_argument("-peakgap", "--peak_gap", required=False, default=None,
+                    help="Merge peaks closer than this many bp; defaults to the window size")
+PARSER.add_argument("-autozoom", "--autozoom", required=False, action="store_true",
+                    help="Make zoomed in plots of every called peak")
 PARSER.add_argument("-mask", "--masking_file", required=False, default=None,
                     help="File with genomic regions to mask"
                          "Chrom\tbeg\tend\n for masking")
 PARSER.add_argument("-zoom", "--zoom_file", required=False, default=None,
                     help="File with regions where you want a zoomed in plot"
                          "Chrom\tbeg\tend\n for zoomed in plotting")
+PARSER.add_argument("-resume", "--resume", required=False, action="store_true",
+                    help="Skip stages and permutation chunks finished by an earlier "
+                         "run with the same inputs")
+PARSER.add_argument("-profile", "--profile", required=False, default=None, nargs="?",
+                    const="time", choices=["time", "memory"],
+                    help="Write the time, peak memory and throughput of each stage "
+                         "to info_files/profile.json. 'memory' also traces the memory "
+                         "allocated by each stage, which makes the run several times slower")
+PARSER.add_argument("-cprofile", "--cprofile", required=False, default=None,
+                    choices=["coverage", "parse", "windows", "fill_in", "permutations", "plots"],
+                    help="Also profile the functions called by one stage with cProfile")
+PARSER.add_argument("-mp", "--start_method", required=False, default=None,
+                    choices=["fork", "spawn", "forkserver"],
+                    help="How worker processes are started; defaults to the platform default")
+PARSER.add_argument("-progress", "--progress", required=False, default=60,
+                    help="Seconds between progress reports of long stages on stderr; 0 for none")
+PARSER.add_argument("-status", "--status_file", required=False, default=None,
+                    help="File that is rewritten with the progress of the current stage")
+PARSER.add_argument("-designs", "--designs", required=False, default=None,
+                    help="TSV or JSON file of several experimental designs to run on the VCF, "
+                         "which is then read once for all of them")
+PARSER.add_argument("-dp", "--design_processes", required=False, default=1,
+                    help="Number of designs of -designs that are run at the same time")
 PARSER.add_argument("-vb", "--verbose", required=False, action="store_true",
                     help="Prints additional files")
 
@@ -133,113 +234,297 @@ PARSER.add_argument("-vb", "--verbose", required=False, action="store_true",
 
 ARGDICT = {}
 
-ARGIES = PARSER.parse_args()
-ARGDICT["vcf"] = ARGIES.vcf
-ARGDICT["outdir"] = ARGIES.outdir
-ARGDICT["outdir1"] = ARGDICT["outdir"]+"/info_files"
-ARGDICT["outdir2"] = ARGDICT["outdir"]+"/BSA_output"
-ARGDICT["outdir3"] = ARGDICT["outdir"]+"/BSA_plots"
-
-ALL_POPS = set()
-
-if ARGIES.selected_parent:
-    ARGDICT["selected_parent"] = ARGIES.selected_parent.split(",")
-    ALL_POPS = ALL_POPS | set(ARGDICT["selected_parent"])
-if ARGIES.control_parent:
-    ARGDICT["control_parent"] = ARGIES.control_parent.split(",")
-    ALL_POPS = ALL_POPS | set(ARGDICT["control_parent"])
-if ARGIES.haplodiploid:
-    ARGDICT["haplodiploid"] = ARGIES.haplodiploid
-if ARGIES.major_parent:
-    ARGDICT["major_parent"] = ARGIES.major_parent.split(",")
-    ALL_POPS = ALL_POPS | set(ARGDICT["major_parent"])
-if ARGIES.selected_offspring:
-    ARGDICT["selected_offspring"] = ARGIES.selected_offspring.split(",")
-    ALL_POPS = ALL_POPS | set(ARGDICT["selected_offspring"])
-if ARGIES.control_offspring:
-    ARGDICT["control_offspring"] = ARGIES.control_offspring.split(",")
-    ALL_POPS = ALL_POPS | set(ARGDICT["control_offspring"])
-
-ARGDICT["mac"] = float(ARGIES.mac)
-ARGDICT["coverage_over"] = float(ARGIES.coverage_over)
-ARGDICT["coverage_under"] = float(ARGIES.coverage_under)
-
-ARGDICT["binsize"] = int(ARGIES.binsize)
-ARGDICT["window"] = int(ARGIES.window)
-ARGDICT["slide"] = int(ARGIES.slide)
-if ARGIES.min_allele:
-    ARGDICT["min_allele"] = int(ARGIES.min_allele)
-else:
-    ARGDICT["min_allele"] = ARGDICT["window"]*0.00050
-ARGDICT["min_scaffold"] = int(ARGIES.min_scaffold)
-ARGDICT["qds"] = float(ARGIES.qds)
-ARGDICT["mps"] = float(ARGIES.mps)
-ARGDICT["sor"] = float(ARGIES.sor)
-ARGDICT["mqrs"] = float(ARGIES.mqrs)
-ARGDICT["rprs"] = float(ARGIES.rprs)
-
-ARGDICT["xstep"] = float(ARGIES.xstep)
-ARGDICT["ystep"] = float(ARGIES.ystep)
-ARGDICT["xticks"] = int(ARGIES.xticks)
-ARGDICT["yticks"] = int(ARGIES.yticks)
-ARGDICT["xminor"] = float(ARGIES.xminor)
-ARGDICT["yminor"] = float(ARGIES.yminor)
-if ARGIES.plot:
-    ARGDICT["plot"] = ARGIES.plot.split(",")
-if ARGIES.permplot:
-    ARGDICT["permplot"] = ARGIES.permplot.split(",")
-       
-ARGDICT["color"] = ARGIES.colors.split(",")
-
-if len(ARGDICT["color"]) == 1:
-    ARGDICT["color"] = ARGDICT["color"][0]
-else:
-    ALL_COLORS_NAME = set([])
-    for collie in matplotlib.colors.cnames.items():
-        ALL_COLORS_NAME.add(str(collie[0]))
-    INVALID_COLORS = []
-    for col in ARGDICT["color"][1:]:
-        if col[0] == "#":
-            match_color = re.search(r'^#(?:[0-9a-fA-F]{3}){1,2}$', col)
-            if not match_color:
-                INVALID_COLORS.append(col)
+def pyplot():
+    """Imports pyplot when the first plot is drawn"""
+    if "matplotlib.pyplot" not in sys.modules:
+        import matplotlib
+        # a backend that is already in use, as in a notebook, is kept
+        matplotlib.use("Agg")
+    from matplotlib import pyplot as plt
+    return(plt)
+
+def mpl_colors():
+    """Imports the color tools of matplotlib when they are first needed"""
+    from matplotlib import colors
+    return(colors)
+
+def parse_args(argv=None):
+    """Turns command line arguments into a dictionary of settings"""
+    argdict = {}
+    argies = PARSER.parse_args(argv)
+    argdict["vcf"] = argies.vcf
+    argdict["outdir"] = argies.outdir
+    argdict["outdir1"] = argdict["outdir"]+"/info_files"
+    argdict["outdir2"] = argdict["outdir"]+"/BSA_output"
+    argdict["outdir3"] = argdict["outdir"]+"/BSA_plots"
+
+    all_pops = set()
+
+    if argies.selected_parent:
+        argdict["selected_parent"] = argies.selected_parent.split(",")
+        all_pops = all_pops | set(argdict["selected_parent"])
+    if argies.control_parent:
+        argdict["control_parent"] = argies.control_parent.split(",")
+        all_pops = all_pops | set(argdict["control_parent"])
+    if argies.haplodiploid:
+        argdict["haplodiploid"] = argies.haplodiploid
+    if argies.major_parent:
+        argdict["major_parent"] = argies.major_parent.split(",")
+        all_pops = all_pops | set(argdict["major_parent"])
+    if argies.selected_offspring:
+        argdict["selected_offspring"] = argies.selected_offspring.split(",")
+        all_pops = all_pops | set(argdict["selected_offspring"])
+    if argies.control_offspring:
+        argdict["control_offspring"] = argies.control_offspring.split(",")
+        all_pops = all_pops | set(argdict["control_offspring"])
+
+
+    argdict["binsize"] = int(argies.binsize)
+    argdict["window"] = int(argies.window)
+    argdict["slide"] = int(argies.slide)
+    if argies.min_allele:
+        argdict["min_allele"] = int(argies.min_allele)
+    else:
+        argdict["min_allele"] = argdict["window"]*0.00050
+    argdict["min_scaffold"] = int(argies.min_scaffold)
+    # the filters take several values separated by commas, e.g. -qds 2,5, to run every set
+    qc_sweep = []
+    for setting in ["mac", "coverage_over", "coverage_under", "qds", "mps", "sor", "mqrs",
+                    "rprs"]:
+        values = [float(i) for i in str(getattr(argies, setting)).split(",")]
+        argdict[setting] = values[0]
+        if len(values) > 1:
+            qc_sweep.append((setting, values))
+    if qc_sweep:
+        argdict["qc_sweep"] = qc_sweep
+
+    argdict["xstep"] = float(argies.xstep)
+    argdict["ystep"] = float(argies.ystep)
+    argdict["xticks"] = int(argies.xticks)
+    argdict["yticks"] = int(argies.yticks)
+    argdict["xminor"] = float(argies.xminor)
+    argdict["yminor"] = float(argies.yminor)
+    argdict["plot_threads"] = int(argies.n_threads)
+    argdict["plot_format"] = argies.plot_format
+    if argies.dpi:
+        argdict["dpi"] = int(argies.dpi)
+    elif argies.plot_format in ["png", "webp"]:
+        argdict["dpi"] = 300
+    else:
+        argdict["dpi"] = 1500
+    if argies.rasterize:
+        argdict["rasterize"] = argies.rasterize
+    if argies.tiles:
+        argdict["tiles"] = argies.tiles
+    if argies.full_resolution:
+        argdict["full_resolution"] = argies.full_resolution
+    if argies.noplot:
+        argdict["noplot"] = argies.noplot
+    if argies.plot:
+        argdict["plot"] = argies.plot.split(",")
+    if argies.permplot:
+        argdict["permplot"] = argies.permplot.split(",")
+
+    argdict["color"] = argies.colors.split(",")
+
+    if len(argdict["color"]) == 1:
+        argdict["color"] = argdict["color"][0]
+    elif "noplot" not in argdict:
+        # matplotlib knows the color names, so they are only checked when plotting
+        all_colors_name = set(str(collie) for collie in mpl_colors().cnames)
+        invalid_colors = []
+        for col in argdict["color"][1:]:
+            if col[0] == "#":
+                match_color = re.search(r'^#(?:[0-9a-fA-F]{3}){1,2}$', col)
+                if not match_color:
+                    invalid_colors.append(col)
+            else:
+                if col not in all_colors_name:
+                    invalid_colors.append(col)
+        if invalid_colors:
+            invalid_string = ",".join(invalid_colors)
+            print("THE FOLLOWING COLORS ARE INVALID: %s"%(invalid_string))
+            sys.exit()
+        if "selected_offspring" in argdict:
+            if len(argdict["color"])-3 != len(argdict["selected_offspring"]):
+                print("INVALID NUMBER OF COLORS! NEED TO PROVIDE COLORS FOR: "
+                    "SELECTED, UNSELECTED, AND ALL THE REPLICATES")
+                sys.exit()
+        if "plot" in argdict:
+            if len(argdict["color"])-1 != len(argdict["plot"]):
+                print("INVALID NUMBER OF COLORS!")
+                sys.exit()
+
+    argdict["perm"] = int(argies.perm)
+    argdict["sig_levels"] = [float(i) for i in argies.significance.split(",")]
+    argdict["sig"] = argdict["sig_levels"][0]
+    if float(argies.perm_tolerance) > 0:
+        argdict["perm_tolerance"] = float(argies.perm_tolerance)
+    argdict["perm_batch"] = int(argies.perm_batch)
+    argdict["sigcolor"] = argies.sigcolor
+    if argies.unpaired:
+        argdict["unpaired"] = argies.unpaired
+        argdict["n_threads"] = int(argies.n_threads)
+        if int(argies.combinations) > 1:
+            argdict["combinations"] = int(argies.combinations)
         else:
-            if col not in ALL_COLORS_NAME:
-                INVALID_COLORS.append(col)
-    if INVALID_COLORS:
-        INVALID_STRING = ",".join(INVALID_COLORS)
-        print("THE FOLLOWING COLORS ARE INVALID: %s"%(INVALID_STRING))
-        sys.exit()
-    if "selected_offspring" in ARGDICT:
-        if len(ARGDICT["color"])-3 != len(ARGDICT["selected_offspring"]):
-            print("INVALID NUMBER OF COLORS! NEED TO PROVIDE COLORS FOR: "
-                "SELECTED, UNSELECTED, AND ALL THE REPLICATES")
+            argdict["combinations"] = math.factorial(len(argdict["control_offspring"]))
+    else:
+        argdict["n_threads"] = 1
+        argdict["combinations"] = 1
+
+    if argies.save_null or argies.null_dir:
+        if argies.null_dir:
+            argdict["null_dir"] = argies.null_dir
+        else:
+            argdict["null_dir"] = argdict["outdir2"]+"/null_distributions"
+    if argies.approx:
+        argdict["approx"] = argies.approx
+        argdict["approx_cal"] = int(argies.approx_calibration)
+        if argies.save_null or argies.null_dir or int(argies.shards) > 0:
+            print("-approx CANNOT BE COMBINED WITH STORED OR SHARDED PERMUTATIONS")
             sys.exit()
-    if "plot" in ARGDICT:
-        if len(ARGDICT["color"])-1 != len(ARGDICT["plot"]):
-            print("INVALID NUMBER OF COLORS!")
+        # the thinned permutations run as one fixed batch, without -ptol or checkpoints
+        if float(argies.perm_tolerance) > 0 or argies.resume:
+            print("-approx CANNOT BE COMBINED WITH -ptol OR -resume")
             sys.exit()
-
-ARGDICT["perm"] = int(ARGIES.perm)
-ARGDICT["sig"] = float(ARGIES.significance)
-ARGDICT["sigcolor"] = ARGIES.sigcolor
-if ARGIES.unpaired:
-    ARGDICT["unpaired"] = ARGIES.unpaired
-    ARGDICT["n_threads"] = int(ARGIES.n_threads)
-    if int(ARGIES.combinations) > 1:
-        ARGDICT["combinations"] = int(ARGIES.combinations)
+    if float(argies.sketch) > 0:
+        argdict["sketch"] = float(argies.sketch)
+        if argies.save_null or argies.null_dir:
+            print("-sketch CANNOT BE COMBINED WITH STORED NULL DISTRIBUTIONS")
+            sys.exit()
+    if int(argies.shards) > 0:
+        argdict["shards"] = int(argies.shards)
+    if int(argies.shard) > 0:
+        argdict["shard"] = int(argies.shard)
+        argdict["n_threads"] = int(argies.n_threads)
+    if argies.merge:
+        argdict["merge"] = argies.merge
+    if "qc_sweep" in argdict and ("shard" in argdict or "merge" in argdict):
+        error("SHARDED PERMUTATIONS TAKE A SINGLE VALUE OF EACH FILTER")
+    if argies.designs:
+        argdict["designs"] = argies.designs
+        argdict["design_processes"] = int(argies.design_processes)
+        if "shard" in argdict or "merge" in argdict:
+            error("SHARDED PERMUTATIONS CANNOT BE RUN FOR SEVERAL DESIGNS AT ONCE")
+    if argies.seed is not None:
+        argdict["seed"] = int(argies.seed)
+    if argies.peaks or argies.autozoom:
+        argdict["peaks"] = True
+    if argies.autozoom:
+        argdict["autozoom"] = argies.autozoom
+    if argies.peak_cutoff:
+        argdict["peak_cutoff"] = float(argies.peak_cutoff)
+    if argies.peak_gap:
+        argdict["peak_gap"] = int(argies.peak_gap)
     else:
-        ARGDICT["combinations"] = math.factorial(len(ARGDICT["control_offspring"]))
-else:
-    ARGDICT["n_threads"] = 1
-    ARGDICT["combinations"] = 1
-
-if ARGIES.masking_file:
-    ARGDICT["masking_file"] = ARGIES.masking_file
-if ARGIES.verbose:
-    ARGDICT["verbose"] = ARGIES.verbose
-if ARGIES.zoom_file:
-    ARGDICT["zoom_file"] = ARGIES.zoom_file
+        argdict["peak_gap"] = argdict["window"]
+    if int(argies.bootstrap) > 0:
+        argdict["boot"] = int(argies.bootstrap)
+        argdict["boot_by"] = argies.bootstrap_by
+        argdict["n_threads"] = int(argies.n_threads)
+    if argies.masking_file:
+        argdict["masking_file"] = argies.masking_file
+    if argies.verbose:
+        argdict["verbose"] = argies.verbose
+    if argies.resume:
+        argdict["resume"] = argies.resume
+    if argies.zoom_file:
+        argdict["zoom_file"] = argies.zoom_file
+    if argies.start_method:
+        argdict["start_method"] = argies.start_method
+    argdict["progress"] = float(argies.progress)
+    if argies.status_file:
+        argdict["status_file"] = argies.status_file
+    if argies.profile or argies.cprofile:
+        argdict["profile"] = argies.profile or "time"
+    if argies.cprofile:
+        argdict["cprofile"] = argies.cprofile
+
+    # every group needs as many samples as there are replicates
+    if "selected_offspring" in argdict and "control_offspring" in argdict:
+        if "control_parent" in argdict and "selected_parent" in argdict:
+            all_groups = [argdict["selected_offspring"], argdict["control_offspring"],
+                          argdict["control_parent"], argdict["selected_parent"]]
+        elif "major_parent" in argdict:
+            all_groups = [argdict["selected_offspring"], argdict["control_offspring"],
+                          argdict["major_parent"]]
+        else:
+            all_groups = [argdict["selected_offspring"], argdict["control_offspring"]]
+            if argdict["perm"]:
+                error("CANNOT RUN PERMUTATIONS IF PARENTAL DATA UNAVAILABLE")
+        lengths = set([len(group) for group in all_groups])
+        if len(lengths) != 1:
+            if len(lengths) == 2 and 1 in lengths:
+                value = int(list(lengths - set([1]))[0])
+                for group in all_groups:
+                    if len(group) == 1:
+                        for _ngroup in range(value-1):
+                            group.append(group[0])
+            else:
+                error("DIFFERENT NUMBERS OF INDIVIDUALS IN GROUPS. EXITING PROGRAM.")
+    argdict["all_pops"] = sorted(all_pops)
+    return(argdict)
+
+def settings_argv(settings):
+    """Turns settings named after the long command line options into arguments"""
+    actions = dict((action.dest, action) for action in PARSER._actions)
+    argv = []
+    for name in sorted(settings):
+        if name not in actions or name == "help":
+            error("UNKNOWN SETTING: %s"%(name))
+        value = settings[name]
+        flag = actions[name].option_strings[-1]
+        if actions[name].nargs == 0:
+            if value:
+                argv.append(flag)
+        elif value is not None:
+            if isinstance(value, (list, tuple)):
+                value = ",".join([str(i) for i in value])
+            argv.extend([flag, str(value)])
+    return(argv)
+
+def read_designs(filey):
+    """Reads the designs of -designs as settings named after the long command line options
+
+    A TSV file has a header of option names, long or short (e.g. psel or
+    selected_parent), and one design per line, where an empty cell leaves the
+    option as on the command line. A JSON file is a list of objects with the
+    same names. The "name" of a design is its directory in the output directory.
+    """
+    actions = {}
+    for action in PARSER._actions:
+        for name in [action.dest] + [flag.lstrip("-") for flag in action.option_strings]:
+            actions[name] = action
+    if not os.path.isfile(filey):
+        error("DESIGN FILE NOT FOUND: %s"%(filey))
+    with open(filey) as opendesigns:
+        text = opendesigns.read()
+    if filey.endswith(".json") or text.lstrip()[:1] == "[":
+        rows = json.loads(text)
+    else:
+        lines = [line.split("\t") for line in text.splitlines() if line.strip()]
+        header = [name.lstrip("#").strip() for name in lines[0]]
+        rows = [dict((name, value.strip()) for name, value in zip(header, line) if value.strip())
+                for line in lines[1:]]
+    designs = []
+    for ix, row in enumerate(rows):
+        name = str(row.get("name", "design%s"%(ix+1)))
+        settings = {}
+        for key in row:
+            if key == "name":
+                continue
+            if key not in actions or actions[key].dest == "help":
+                error("UNKNOWN OPTION IN DESIGN %s: %s"%(name, key))
+            value = row[key]
+            if actions[key].nargs == 0 and not isinstance(value, bool):
+                value = str(value).lower() in ["1", "true", "yes"]
+            settings[actions[key].dest] = value
+        designs.append((name, settings))
+    names = [name for name, _settings in designs]
+    if not names or len(set(names)) < len(names):
+        error("THE DESIGNS OF %s NEED DIFFERENT NAMES"%(filey))
+    return(designs)
 
 PREFIX = {0:'bp',
           1:'kb', # kilo
@@ -297,58 +582,64 @@ def afill(start, end, ntries):
     final_list = [float(start) + (i+1)*step for i in range(ntries)]
     return(final_list)
 
-# this function processes scaffold linermation
-def scale_dict(line_file):
-    """Creates a dict with cumulative positions for each chromosome"""
-    line_read = open(line_file, "r")
-    line_dict = {}
-    final_lenny = 0
-    lenny = 0
-    scaffolds = []
-    for line in line_read:
-        linetab = (line.rstrip()).split("\t")
-        scaffy = linetab[0]
-        scaffolds.append(scaffy)
-        final_lenny = final_lenny + lenny
-        lenny = int(linetab[1])
-        line_dict[scaffy] = final_lenny
-    line_read.close()
-    return(line_dict, scaffolds)
-
-# this function processes scaffold linermation
-def length_dict(line_file):
-    """Creates a dict with chromosome lengths"""
-    line_read = open(line_file, "r")
-    line_dict = {}
-    for line in line_read:
-        linetab = (line.rstrip()).split("\t")
-        scaffy = linetab[0]
-        lenny = int(linetab[1])
-        line_dict[scaffy] = lenny
-    line_read.close()
-    return(line_dict)
-
-def scale_ends(line_file):
-    """Creates a dict with ends for each chromosome"""
+class GenomeIndex(object):
+    """Contig order, lengths and cumulative offsets from chrom_file.txt"""
+
+    def __init__(self, line_file):
+        self.names = []
+        lengths = []
+        with open(line_file, "r") as line_read:
+            for line in line_read:
+                linetab = (line.rstrip()).split("\t")
+                self.names.append(linetab[0])
+                lengths.append(int(linetab[1]))
+        self.contig_ix = dict((name, ix) for ix, name in enumerate(self.names))
+        self.lengths = np.array(lengths, dtype=np.int64)
+        self.ends = np.cumsum(self.lengths)
+        self.offsets = self.ends - self.lengths
+        self.size = int(self.ends[-1]) if len(self.ends) else 0
+
+    def offset(self, chrom):
+        """Genome-wide position where a contig starts"""
+        return(int(self.offsets[self.contig_ix[chrom]]))
+
+    def length(self, chrom):
+        """Length of a contig"""
+        return(int(self.lengths[self.contig_ix[chrom]]))
+
+    def end(self, chrom):
+        """Genome-wide position where a contig ends"""
+        return(int(self.ends[self.contig_ix[chrom]]))
+
+    def contig_of(self, positions):
+        """Index of the contig each genome-wide position falls on"""
+        return(np.searchsorted(self.offsets, positions, side="right") - 1)
+
+    def to_global(self, chroms, positions):
+        """Converts contig positions to genome-wide positions"""
+        names, inverse = np.unique(np.asarray(chroms), return_inverse=True)
+        offsets = np.array([self.offsets[self.contig_ix[name]] for name in names])
+        return(np.asarray(positions) + offsets[inverse])
+
+    def to_local(self, positions):
+        """Converts genome-wide positions to contig names and contig positions"""
+        chrom_ix = self.contig_of(positions)
+        return(np.array(self.names)[chrom_ix], np.asarray(positions) - self.offsets[chrom_ix])
+
+def genome_index():
+    """Loads chrom_file.txt once, and again only if the file changes"""
+    line_file = ARGDICT["outdir1"] + "/chrom_file.txt"
     try:
-        line_read = open(line_file, "r")
-    except IOError:
+        stamp = os.stat(line_file)
+    except OSError:
         error("FILE NOT FOUND, LIKELY BECAUSE YOU ARE RUNNING "
               "THE PLOTTING CODE. MOVE THE info_files DIRECTORY "
               "INTO YOUR OUTDIR FOR THIS TO WORK")
-    line_dict = {}
-    final_lenny = 0
-    lenny = 0
-    scaffolds = []
-    for line in line_read:
-        linetab = (line.rstrip()).split("\t")
-        scaffy = linetab[0]
-        scaffolds.append(scaffy)
-        lenny = int(linetab[1])
-        final_lenny = final_lenny + lenny
-        line_dict[scaffy] = final_lenny
-    line_read.close()
-    return(line_dict, scaffolds)
+    key = (line_file, stamp.st_mtime, stamp.st_size)
+    if key not in GENOME_CACHE:
+        GENOME_CACHE.clear()
+        GENOME_CACHE[key] = GenomeIndex(line_file)
+    return(GENOME_CACHE[key])
 
 def masker():
     """Specifies regions of genome to mask"""
@@ -365,8 +656,7 @@ def masker():
             if line[0] not in maskdict:
                 maskdict[line[0]] = set(range(int(line[1]), int(line[2])+1))
             maskdict[line[0]] = maskdict[line[0]] | set(range(int(line[1]), int(line[2])+1))
-    scaffs = scale_dict(ARGDICT["outdir1"] + "/chrom_file.txt")[1]
-    for scaff in scaffs:
+    for scaff in genome_index().names:
         if scaff not in maskdict:
             maskdict[scaff] = set([-1])
     return(maskdict)
@@ -388,6 +678,207 @@ def verbosy(indict, contigs, outkeys):
                     # should remove binny once i test this
                     outfile.write("%s\t%s\t%s\t%s\n"%(contig, position, binny, value))
                     outfile.close()
+
+def file_signature(filey):
+    """Describes a file by its path, size and modification time"""
+    if filey and os.path.isfile(filey):
+        stats = os.stat(filey)
+        return("%s;%s;%s"%(os.path.abspath(filey), stats.st_size, int(stats.st_mtime)))
+    return(str(filey))
+
+def stage_key(upstream, settings):
+    """Hashes the inputs of a pipeline stage"""
+    hasher = hashlib.sha1(upstream.encode())
+    for setting in settings:
+        hasher.update(("%s=%r;"%(setting, ARGDICT.get(setting))).encode())
+    return(hasher.hexdigest())
+
+def count_units(unit, number):
+    """Records how many items a stage processed, for its throughput in -profile"""
+    PROFILE_UNITS[unit] = PROFILE_UNITS.get(unit, 0) + number
+
+def profiled(stage, func, *args):
+    """Runs a stage and, with -profile, records its time, memory and throughput"""
+    if "profile" not in ARGDICT:
+        return(func(*args))
+    tracing = ARGDICT["profile"] == "memory"
+    if tracing and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    PROFILE_UNITS.clear()
+    # the workers of a stage are joined before it ends, so their time is in RUSAGE_CHILDREN
+    before = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    traced = tracemalloc.get_traced_memory()[0]
+    if tracing and hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+    profiler = cProfile.Profile() if ARGDICT.get("cprofile") == stage else None
+    wall = time.time()
+    if profiler:
+        profiler.enable()
+    result = func(*args)
+    if profiler:
+        profiler.disable()
+    wall = time.time() - wall
+    after = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss_unit = 1024.0**2 if sys.platform == "darwin" else 1024.0
+    measures = {"stage": stage, "wall_s": wall,
+                "cpu_s": sum(after[ix].ru_utime - before[ix].ru_utime
+                             + after[ix].ru_stime - before[ix].ru_stime for ix in range(2)),
+                "peak_rss_mb": after[0].ru_maxrss/rss_unit,
+                "workers_peak_rss_mb": after[1].ru_maxrss/rss_unit,
+                "counts": dict(PROFILE_UNITS),
+                "per_second": dict(("%s_per_s"%(unit), PROFILE_UNITS[unit]/wall)
+                                   for unit in PROFILE_UNITS if wall)}
+    if tracing:
+        current, peak = tracemalloc.get_traced_memory()
+        measures["traced_change_mb"] = (current - traced)/1024.0**2
+        measures["traced_peak_mb"] = peak/1024.0**2
+    PROFILE.append(measures)
+    print("PROFILE: %s TOOK %.2f S WALL, %.2f S CPU, PEAK RSS %.0f MB"%(
+        stage.upper(), wall, measures["cpu_s"], measures["peak_rss_mb"]))
+    with open(ARGDICT["outdir1"]+"/profile.json", "w") as profile_out:
+        json.dump({"vcf": ARGDICT.get("vcf"), "stages": PROFILE}, profile_out, indent=1)
+    if profiler:
+        profiler.dump_stats(ARGDICT["outdir1"]+"/profile_%s.prof"%(stage))
+        with open(ARGDICT["outdir1"]+"/profile_%s.txt"%(stage), "w") as stats_out:
+            pstats.Stats(profiler, stream=stats_out).sort_stats("cumulative").print_stats(40)
+    return(result)
+
+def checkpoint(stage, key, outputs, func, *args):
+    """Runs a pipeline stage unless an earlier run finished it with the same inputs"""
+    ckpt_dir = ARGDICT["outdir1"]+"/checkpoints"
+    marker = ckpt_dir+"/%s.done"%(stage)
+    saved = ckpt_dir+"/%s.pkl"%(stage)
+    if ("resume" in ARGDICT and os.path.isfile(marker) and os.path.isfile(saved)
+            and all(os.path.isfile(output) for output in outputs)):
+        with open(marker) as openmarker:
+            if openmarker.read().strip() == key:
+                print("RESUMING: %s STAGE ALREADY FINISHED"%(stage.upper()))
+                with open(saved, "rb") as opensaved:
+                    return(pickle.load(opensaved))
+    result = profiled(stage, func, *args)
+    if not os.path.isdir(ckpt_dir):
+        os.makedirs(ckpt_dir)
+    with open(saved+".tmp", "wb") as saved_out:
+        pickle.dump(result, saved_out, protocol=pickle.HIGHEST_PROTOCOL)
+    os.rename(saved+".tmp", saved)
+    with open(marker, "w") as marker_out:
+        marker_out.write("%s\n"%(key))
+    return(result)
+
+def init_worker(argdict, counters=None):
+    """Gives a worker process the settings of the run that started it"""
+    global ARGDICT, PERM_COUNTERS
+    ARGDICT = argdict
+    PERM_COUNTERS = counters
+
+def worker_pool(processes, counters=None):
+    """Starts worker processes with the chosen start method and this run's settings"""
+    context = multiprocessing.get_context(ARGDICT.get("start_method"))
+    # the windows of every sample are only needed by the main process
+    argdict = dict((key, ARGDICT[key]) for key in ARGDICT
+                   if key not in ["master_dict", "perm_results"])
+    return(context.Pool(processes=processes, initializer=init_worker,
+                        initargs=(argdict, counters)))
+
+def run_experiment(experiment):
+    """Runs every step of an experiment, in a process of its own"""
+    experiment.run()
+
+def run_experiments(experiments, processes=1):
+    """Runs experiments one after the other, or several at a time in processes of their own"""
+    if processes < 2:
+        for experiment in experiments:
+            print("RUNNING %s"%(experiment.argdict["outdir"]))
+            experiment.run()
+        return
+    # the experiments start workers of their own, which the workers of a Pool cannot
+    context = multiprocessing.get_context(ARGDICT.get("start_method"))
+    pending = list(experiments)
+    running = {}
+    failed = []
+    while pending or running:
+        while pending and len(running) < processes:
+            experiment = pending.pop(0)
+            print("RUNNING %s"%(experiment.argdict["outdir"]))
+            process = context.Process(target=run_experiment, args=(experiment,))
+            process.start()
+            running[process.sentinel] = (process, experiment.argdict["outdir"])
+        for sentinel in connection.wait(list(running)):
+            process, outdir = running.pop(sentinel)
+            process.join()
+            if process.exitcode:
+                failed.append(outdir)
+    if failed:
+        error("THESE RUNS FAILED: %s"%(", ".join(failed)))
+
+def duration(seconds):
+    """Formats seconds as hours:minutes:seconds"""
+    seconds = int(round(seconds))
+    return("%d:%02d:%02d"%(seconds//3600, seconds//60 % 60, seconds % 60))
+
+class Progress(object):
+    """Reports how far a long stage is on stderr and in the -status file"""
+
+    def __init__(self, stage, total, measure, unit, resumed=0):
+        self.stage = stage
+        self.total = total
+        # done by an earlier run, so not part of the rate
+        self.resumed = resumed
+        self.measure = measure
+        self.unit = unit
+        self.start = time.time()
+        self.last = self.start
+        # a status file alone is updated every minute
+        self.interval = ARGDICT["progress"] or 60
+        self.enabled = ARGDICT["progress"] > 0 or "status_file" in ARGDICT
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def update(self, done, items=None, force=False, **details):
+        """Reports done out of total, and items per second, if a report is due"""
+        now = time.time()
+        if not self.enabled or (not force and now - self.last < self.interval):
+            return
+        self.last = now
+        items = done - self.resumed if items is None else items
+        rate = items/(now - self.start) if now > self.start else 0.0
+        done_rate = (done - self.resumed)/(now - self.start) if now > self.start else 0.0
+        eta = (self.total - done)/done_rate if self.total and done_rate else None
+        status = {"stage": self.stage, "done": done, "total": self.total,
+                  "measure": self.measure,
+                  "percent": 100.0*done/self.total if self.total else None,
+                  "%s_per_s"%(self.unit): rate, "elapsed_s": now - self.start,
+                  "eta_s": eta, "updated": time.strftime("%Y-%m-%d %H:%M:%S")}
+        status.update(details)
+        if ARGDICT["progress"]:
+            sys.stderr.write("PROGRESS %s: %s of %s %s (%.1f%%), %.0f %s/s, ETA %s%s\n"%(
+                self.stage.upper(), done, self.total, self.measure, status["percent"] or 0,
+                rate, self.unit, duration(eta) if eta is not None else "unknown",
+                "".join(", %s %s"%(key, details[key]) for key in sorted(details))))
+        if "status_file" in ARGDICT:
+            with open(ARGDICT["status_file"]+".tmp", "w") as status_out:
+                json.dump(status, status_out)
+            os.rename(ARGDICT["status_file"]+".tmp", ARGDICT["status_file"])
+
+    def watch(self, poll):
+        """Reports what poll() returns from a thread until finish() is called"""
+        def report():
+            while not self.stopped.wait(self.interval):
+                done, details = poll()
+                self.update(done, force=True, **details)
+        if not self.enabled:
+            return
+        self.thread = threading.Thread(target=report)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def finish(self):
+        """Stops the reporting thread"""
+        if self.thread:
+            self.stopped.set()
+            self.thread.join()
+
 # COVERAGE
 def coverage():
     """Calculates average coverage per strain/individual"""
@@ -398,8 +889,11 @@ def coverage():
     outcov = open(ARGDICT["outdir1"]+"/coverageinfo.txt", "w")
     line_file_handle = open(ARGDICT["outdir1"]+"/chrom_file.txt", "w")
     the_right_stuff = set()
+    number_lines = 0
+    progress = Progress("coverage", os.path.getsize(ARGDICT["vcf"]), "bytes", "lines")
     openvcf = open(ARGDICT["vcf"])
     for line in openvcf:
+        number_lines += 1
         if line[0] == "#":
             if line.split("=")[0] == "##contig":
                 line = line.split("=")
@@ -410,31 +904,35 @@ def coverage():
                     line_file_handle.write("%s\t%s\n"%(vcf_scaff, vcf_scaff_len))
             elif line[0:6] == "#CHROM":
                 header_strains = line.strip().split("\t")[9:]
-                not_in_vcf = ALL_POPS - set(header_strains)
+                not_in_vcf = set(ARGDICT["all_pops"]) - set(header_strains)
                 if len(not_in_vcf) > 0:
                     not_in_vcf_string = ",".join(not_in_vcf)
                     print("INVALID STRAIN NAMES: %s. EXITING PROGRAM"%(not_in_vcf_string))
                     sys.exit()
-                right_strains = [st for st in header_strains if st in ALL_POPS]
-                indexed_strains = [header_strains.index(st) for st in right_strains]
+                right_strains = [st for st in header_strains if st in ARGDICT["all_pops"]]
+                # columns after the last analysed sample are left unsplit
+                indexed_strains = [header_strains.index(st) + 9 for st in right_strains]
+                maxcol = max(indexed_strains + [8])
                 for strain in right_strains:
                     cov[strain] = {}
                     cov[strain]["cov"] = 0.0
                     cov[strain]["total"] = 0.0
         else:
-            line = line.replace("|", "/")
-            line = line.strip().split("\t")
-            info = line[9:]
+            line = line.split("\t", maxcol + 1)
+            if not number_lines % PROGRESS_LINES:
+                progress.update(openvcf.buffer.tell(), number_lines, contig=line[0])
             if (line[0] in the_right_stuff
                     and len(line[3]) == 1
                     and len(line[4].split(",")) == 1):
                 for ix_strain in zip(indexed_strains, right_strains):
-                    if "./" not in info[ix_strain[0]]:
-                        reads = info[ix_strain[0]].split(":")[1].split(",")
+                    call = line[ix_strain[0]].replace("|", "/")
+                    if "./" not in call:
+                        reads = call.split(":")[1].split(",")
                         parent_cov = sum([int(i) for i in reads])
                         cov[ix_strain[1]]["cov"] = cov[ix_strain[1]]["cov"]  + parent_cov
                         cov[ix_strain[1]]["total"] = cov[ix_strain[1]]["total"] + 1
     openvcf.close()
+    count_units("lines", number_lines)
     line_file_handle.close()
     for strain in right_strains:
         avecov = cov[strain]["cov"]/cov[strain]["total"]
@@ -455,6 +953,22 @@ def round_sig(xxx, sig):
         output = 0
     return(output)
 
+def tally(counts, key):
+    """Adds one to a counter of the filter funnel"""
+    counts[key] = counts.get(key, 0) + 1
+
+def call_rejects(rejected, indv, samples, cov):
+    """Notes why the calls of a replicate were not used: a missing call or the coverage bounds"""
+    for call, spl in zip(indv, samples):
+        if "." in call:
+            rejected.add(("sample", "missing_call", spl))
+            return
+    for call, spl in zip(indv, samples):
+        if not (cov[spl]*ARGDICT["coverage_under"] <= spt_vcfcov(call)
+                <= cov[spl]*ARGDICT["coverage_over"]):
+            rejected.add(("sample", "coverage", spl))
+            return
+
 def inferred(indv):
     """Process offspring information when information only from a single parent"""
     exp_genosplito = set(indv[2].split(":")[0].split("/"))
@@ -520,6 +1034,20 @@ def haplodiploid(indv):
                 sample_scores = [1-i for i in sample_scores]
             return(sample_scores)
 
+def hpd_reject(indv):
+    """Whether haplodiploid() left out a replicate for its parents or for -mac"""
+    exp_genosplito = set(indv[2].split(":")[0].split("/"))
+    cont_genosplito = set(indv[3].split(":")[0].split("/"))
+    # only a replicate with one heterozygous parent in the right place can fail -mac
+    if (len(exp_genosplito | cont_genosplito) == 2
+            and len(exp_genosplito) + len(cont_genosplito) == 3
+            and ((len(exp_genosplito) == 1
+                  and ARGDICT["haplodiploid"] in ARGDICT["control_parent"])
+                 or (len(cont_genosplito) == 1
+                     and ARGDICT["haplodiploid"] in ARGDICT["selected_parent"]))):
+        return("mac")
+    return("parents")
+
 def both_fixed(indv):
     """Process offspring information when both parents fixed"""
     exp_genosplito = set(indv[1].split(":")[0].split("/"))
@@ -539,11 +1067,12 @@ def both_fixed(indv):
             sample_score = 0.0
         return(sample_score)
 
-def process_noparents(line, vcfline, cov):
+def process_noparents(info, vcfline, cov, rejects):
     """Processes each line of a VCF file when parents are not specified"""
     # now let's parse it for each replicate:
     outdict = {}
-    info = line[9:]
+    # a sample can be in several replicates, like a parent, but is counted once per SNP
+    rejected = set()
     for sample in zip(ARGDICT["selected_offspring"], ARGDICT["control_offspring"]):
         scores = []
         indv = [info[vcfline.index(sample[0])],
@@ -563,13 +1092,20 @@ def process_noparents(line, vcfline, cov):
                     and len(low_scores) < len(scores)):
                 outdict[sample[0]] = abs(scores[0] - scores[1])
                 outdict[sample[1]] = 0
+            else:
+                rejected.add(("sample", "mac", sample[0]))
+        else:
+            call_rejects(rejected, indv, sample, cov)
+    for key in rejected:
+        tally(rejects, key)
     return(outdict)
 
-def process_infer(line, vcfline, cov):
+def process_infer(info, vcfline, cov, rejects):
     """Processes each line of a VCF file when only one parent is specified"""
     # now let's parse it for each replicate:
     outdict = {}
-    info = line[9:]
+    # a sample can be in several replicates, like a parent, but is counted once per SNP
+    rejected = set()
     for sample in zip(ARGDICT["selected_offspring"],
                       ARGDICT["control_offspring"],
                       ARGDICT["major_parent"]):
@@ -588,13 +1124,22 @@ def process_infer(line, vcfline, cov):
             if sample_scores:
                 outdict[sample[0]] = sample_scores[0]
                 outdict[sample[1]] = sample_scores[1]
+            elif len(set(indv[2].split(":")[0].split("/"))) == 1:
+                rejected.add(("sample", "mac", sample[0]))
+            else:
+                rejected.add(("sample", "parents", sample[0]))
+        else:
+            call_rejects(rejected, indv, sample, cov)
+    for key in rejected:
+        tally(rejects, key)
     return(outdict)
 
-def process_hpd(line, vcfline, cov):
+def process_hpd(info, vcfline, cov, rejects):
     """Processes each line of a VCF file when parents are not specified"""
     # now let's parse it for each replicate:
     outdict = {}
-    info = line[9:]
+    # a sample can be in several replicates, like a parent, but is counted once per SNP
+    rejected = set()
     for sample in zip(ARGDICT["selected_offspring"],
                       ARGDICT["control_offspring"],
                       ARGDICT["selected_parent"],
@@ -617,13 +1162,20 @@ def process_hpd(line, vcfline, cov):
             if sample_scores:
                 outdict[sample[0]] = sample_scores[0]
                 outdict[sample[1]] = sample_scores[1]
+            else:
+                rejected.add(("sample", hpd_reject(indv), sample[0]))
+        else:
+            call_rejects(rejected, indv, sample, cov)
+    for key in rejected:
+        tally(rejects, key)
     return(outdict)
 
-def process_samples(line, vcfline, cov):
+def process_samples(info, vcfline, cov, rejects):
     """Processes each line of a VCF file"""
     # now let's parse it for each replicate:
     outdict = {}
-    info = line[9:]
+    # a sample can be in several replicates, like a parent, but is counted once per SNP
+    rejected = set()
     for sample in zip(ARGDICT["selected_offspring"]+ARGDICT["control_offspring"],
                       ARGDICT["selected_parent"]*2,
                       ARGDICT["control_parent"]*2):
@@ -641,6 +1193,12 @@ def process_samples(line, vcfline, cov):
             sample_score = both_fixed(indv)
             if sample_score is not None:
                 outdict[sample[0]] = sample_score
+            else:
+                rejected.add(("sample", "parents", sample[0]))
+        else:
+            call_rejects(rejected, indv, sample, cov)
+    for key in rejected:
+        tally(rejects, key)
     return(outdict)
 
 def line_parser(line):
@@ -655,76 +1213,209 @@ def line_parser(line):
             linedict[keyval[0]] = str(keyval[1])
     return(linedict)
 
-def get_vcftuple():
-    """Parses the VCF file, filters SNPs, and extracts relevant information"""
+def vcf_snps(openvcf, columns):
+    """Yields the biallelic SNPs of the analysed contigs, one VCF line at a time"""
+    genome = genome_index()
+    progress = Progress("parse", os.path.getsize(ARGDICT["vcf"]), "bytes", "SNPs")
+    number_lines = 0
+    # only the columns up to the last analysed sample are split
+    maxcol = max(columns + [7])
+    with openvcf:
+        for line in openvcf:
+            line = line.split("\t", maxcol + 1)
+            chrom = line[0]
+            number_lines += 1
+            if not number_lines % PROGRESS_LINES:
+                progress.update(openvcf.buffer.tell(), number_lines, contig=chrom)
+            if (chrom in genome.contig_ix
+                    and len(line[3]) == 1 and len(line[4]) == 1):
+                # only the columns of the analysed samples are kept, with unphased calls
+                yield (chrom, int(line[1]), line_parser(line[7]),
+                       [line[col].rstrip().replace("|", "/") for col in columns])
+
+def read_vcf(keep=False):
+    """Reads the SNPs of the VCF as they are needed, or all at once if keep is set"""
+    print("READING VARIANTS FROM VCF")
+    openvcf = open(ARGDICT["vcf"], "r")
+    header = []
+    for line in openvcf:
+        if line[0:6] == "#CHROM":
+            header = line.rstrip().split("\t")
+            break
+    columns = [header.index(spl) for spl in ARGDICT["all_pops"]]
+    records = vcf_snps(openvcf, columns)
+    if keep:
+        records = list(records)
+    return(ARGDICT["all_pops"], records)
+
+QC_CRITERIA = [("QD", "qds", 1), ("MQ", "mps", 1), ("SOR", "sor", -1),
+               ("MQRankSum", "mqrs", 1), ("ReadPosRankSum", "rprs", 1)]
+
+def qc_rejects(rejects, masked, quals, settings):
+    """Counts the first QC criterion a SNP fails in the funnel, and every criterion it fails"""
+    fails = ["masked"] if masked else []
+    for name, setting, sign in QC_CRITERIA:
+        # SOR is an upper bound, the other annotations are lower bounds
+        if (quals[name] < settings[setting] if sign > 0 else quals[name] >= settings[setting]):
+            fails.append(name)
+    tally(rejects, ("funnel", fails[0], "all"))
+    for name in fails:
+        tally(rejects, ("criterion", name, "all"))
+
+def write_funnel(funnel):
+    """Writes how many SNPs and samples each filter removed, per chromosome and in total"""
+    totals = {}
+    for chrom in funnel:
+        for key in funnel[chrom]:
+            totals[key] = totals.get(key, 0) + funnel[chrom][key]
+    steps = (["considered", "annotations", "masked"] + [crit[0] for crit in QC_CRITERIA]
+             + ["no_replicate", "passed"])
+    samples = ["all"] + ARGDICT["all_pops"]
+    order = dict((key, ix) for ix, key in enumerate(
+        [(level, step) for level in ["funnel", "criterion", "sample"]
+         for step in steps + ["missing_call", "coverage", "parents", "mac"]]))
+    genome = genome_index()
+    with open(ARGDICT["outdir1"]+"/filter_funnel.txt", "w") as funnel_out:
+        funnel_out.write("#level\treason\tchrom\tsample\tsnps\n")
+        for chrom, counts in [("all", totals)] + [(chrom, funnel[chrom]) for chrom in
+                                                  sorted(funnel, key=genome.contig_ix.get)]:
+            for key in sorted(counts, key=lambda key: (order[key[:2]], samples.index(key[2]))):
+                funnel_out.write("%s\t%s\t%s\t%s\t%s\n"%(key[0], key[1], chrom, key[2],
+                                                          counts[key]))
+
+# settings that change the scores of the replicates at a SNP that passed QC
+SCORE_SETTINGS = ["selected_parent", "control_parent", "major_parent", "haplodiploid",
+                  "selected_offspring", "control_offspring", "mac", "coverage_over",
+                  "coverage_under"]
+
+def snp_scorer():
+    """The function that scores the replicates of a SNP for the parents that were given"""
+    if ("selected_parent" and "control_parent" in ARGDICT
+            and "haplodiploid" not in ARGDICT):
+        return(process_samples)
+    elif ("selected_parent" and "control_parent" in ARGDICT
+          and "haplodiploid" in ARGDICT):
+        return(process_hpd)
+    elif "major_parent" in ARGDICT:
+        return(process_infer)
+    return(process_noparents)
+
+def get_vcftuples(raw, argdicts):
+    """Filters the SNPs read once from the VCF with several sets of settings
+
+    Each SNP gets a bitmask of the sets whose QC it passes, and its replicates
+    are scored once for all the sets that score them alike.
+    """
+    global ARGDICT
+    active = ARGDICT
+    if raw is None:
+        raw = read_vcf()
     print("PARSING VCF TO ANALYZE VARIANTS")
-    chrom_tuple = scale_ends(ARGDICT["outdir1"] + "/chrom_file.txt")
-    chrom_dict = chrom_tuple[0]
-    chroms = chrom_tuple[1]
+    genome = genome_index()
+    vcfline, records = raw
     number_total_snps = 0
-    number_qc_snps = 0
-    number_passed_snps = 0
     cov = {}
     with open(ARGDICT["outdir1"] + "/coverageinfo.txt", "r") as opencov:
         for line in opencov:
             line = (line.rstrip()).split("\t")
             strain = line[0]
             cov[strain] = float(line[1])
-    masking = masker()
-    openvcf = open(ARGDICT["vcf"], "r") # feeds the file line by line (see below)
-    vcfdict = {}
+    qc_sets = []
+    for argdict in argdicts:
+        ARGDICT = argdict
+        qc_sets.append({"settings": argdict, "masking": masker(), "scorer": snp_scorer(),
+                        "group": tuple(repr(argdict.get(setting)) for setting in
+                                       SCORE_SETTINGS),
+                        "vcfdict": {}, "funnel": {}, "bin": 1, "qc": 0, "passed": 0})
+    ARGDICT = active
     contigs = []
-    vcfline = None
-    outkeys = [i for i in ARGDICT["selected_offspring"]+ARGDICT["control_offspring"]]
-    for line in openvcf: # let's go over each line
-        line = line.replace("|", "/")
-        line = line.rstrip().split("\t")
-        chrom = line[0]
-        vcfline = line[9:] if chrom == "#CHROM" else vcfline
-        if (chrom in chroms
-                and len(line[3]) == 1 and len(line[4]) == 1):
-            pos = int(line[1])
-            quals = line_parser(line[7])
-            number_total_snps += 1
-            if ("QD" in quals and "MQ" in quals and "SOR" in quals
-                    and "MQRankSum" in quals and "ReadPosRankSum" in quals):
-                if chrom not in contigs:
-                    vcfdict[chrom] = {}
-                    for binny in range(1, chrom_dict[chrom], ARGDICT["binsize"]):
-                        vcfdict[chrom][binny] = {}
-                    contigs.append(chrom)
-                    current_bin = 1
-                if pos >= current_bin + ARGDICT["binsize"]:
-                    while pos >= current_bin + ARGDICT["binsize"]:
-                        current_bin = current_bin + ARGDICT["binsize"]
-                if (pos not in masking[chrom]
-                        and quals["QD"] >= ARGDICT["qds"]
-                        and quals["MQ"] >= ARGDICT["mps"]
-                        and quals["SOR"] < ARGDICT["sor"]
-                        and quals["MQRankSum"] >= ARGDICT["mqrs"]
-                        and quals["ReadPosRankSum"] >= ARGDICT["rprs"]):
-                    vcfdict[chrom][current_bin][pos] = {}
-                    number_qc_snps += 1
-                    if ("selected_parent" and "control_parent" in ARGDICT
-                            and "haplodiploid" not in ARGDICT):
-                        outdict = process_samples(line, vcfline, cov)
-                    elif ("selected_parent" and "control_parent" in ARGDICT
-                            and "haplodiploid" in ARGDICT):
-                        outdict = process_hpd(line, vcfline, cov)
-                    elif "major_parent" in ARGDICT:
-                        outdict = process_infer(line, vcfline, cov)
-                    else:
-                        outdict = process_noparents(line, vcfline, cov)
-                    if outdict:
-                        number_passed_snps += 1
-                        for sample in outdict:
-                            vcfdict[chrom][current_bin][pos][sample] = outdict[sample]
+    # SNPs considered and SNPs without annotations are the same for every set
+    shared = {}
+    for chrom, pos, quals, info in records:
+        number_total_snps += 1
+        # rejections are counted for each chromosome, and only when they happen
+        if chrom not in shared:
+            shared[chrom] = {}
+            for qc_set in qc_sets:
+                qc_set["funnel"][chrom] = {}
+        tally(shared[chrom], ("funnel", "considered", "all"))
+        if not ("QD" in quals and "MQ" in quals and "SOR" in quals
+                and "MQRankSum" in quals and "ReadPosRankSum" in quals):
+            tally(shared[chrom], ("funnel", "annotations", "all"))
+            continue
+        if chrom not in contigs:
+            for qc_set in qc_sets:
+                binsize = qc_set["settings"]["binsize"]
+                qc_set["vcfdict"][chrom] = {}
+                for binny in range(1, genome.end(chrom), binsize):
+                    qc_set["vcfdict"][chrom][binny] = {}
+                qc_set["bin"] = 1
+            contigs.append(chrom)
+        passes = 0
+        for ix, qc_set in enumerate(qc_sets):
+            settings = qc_set["settings"]
+            masked = pos in qc_set["masking"][chrom]
+            if (not masked
+                    and quals["QD"] >= settings["qds"]
+                    and quals["MQ"] >= settings["mps"]
+                    and quals["SOR"] < settings["sor"]
+                    and quals["MQRankSum"] >= settings["mqrs"]
+                    and quals["ReadPosRankSum"] >= settings["rprs"]):
+                passes |= 1 << ix
+            else:
+                qc_rejects(qc_set["funnel"][chrom], masked, quals, settings)
+        if not passes:
+            continue
+        scored = {}
+        for ix, qc_set in enumerate(qc_sets):
+            if not passes >> ix & 1:
+                continue
+            binsize = qc_set["settings"]["binsize"]
+            while pos >= qc_set["bin"] + binsize:
+                qc_set["bin"] = qc_set["bin"] + binsize
+            qc_set["qc"] += 1
+            if qc_set["group"] not in scored:
+                ARGDICT = qc_set["settings"]
+                rejects = {}
+                scored[qc_set["group"]] = (qc_set["scorer"](info, vcfline, cov, rejects),
+                                           rejects)
+            outdict, rejects = scored[qc_set["group"]]
+            funnel = qc_set["funnel"][chrom]
+            for key in rejects:
+                funnel[key] = funnel.get(key, 0) + rejects[key]
+            qc_set["vcfdict"][chrom][qc_set["bin"]][pos] = dict(outdict)
+            if outdict:
+                qc_set["passed"] += 1
+                tally(funnel, ("funnel", "passed", "all"))
+            else:
+                tally(funnel, ("funnel", "no_replicate", "all"))
+    ARGDICT = active
+    count_units("snps", number_total_snps)
+    results = []
+    for qc_set in qc_sets:
+        for chrom in shared:
+            qc_set["funnel"][chrom].update(shared[chrom])
+        outkeys = [i for i in qc_set["settings"]["selected_offspring"]
+                   + qc_set["settings"]["control_offspring"]]
+        results.append({"vcf_tuple": (qc_set["vcfdict"], list(contigs), outkeys),
+                        "funnel": qc_set["funnel"], "total": number_total_snps,
+                        "qc": qc_set["qc"], "passed": qc_set["passed"]})
+    return(results)
+
+def report_vcftuple(result):
+    """Writes the filter funnel and, with -verbose, the allele information of a set"""
+    write_funnel(result["funnel"])
     if "verbose" in ARGDICT:
-        verbosy(vcfdict, contigs, outkeys)
-    print("the total number of SNPs considered is %s"%(number_total_snps))
-    print("the total number of SNPs that passed QC is %s"%(number_qc_snps))
-    print("the total number of SNPs that passed QC and BSA cutoffs is %s"%(number_passed_snps))
-    return(vcfdict, contigs, outkeys)
+        verbosy(*result["vcf_tuple"])
+    print("the total number of SNPs considered is %s"%(result["total"]))
+    print("the total number of SNPs that passed QC is %s"%(result["qc"]))
+    print("the total number of SNPs that passed QC and BSA cutoffs is %s"%(result["passed"]))
+
+def get_vcftuple(raw=None):
+    """Filters the SNPs read from the VCF and extracts relevant information"""
+    result = get_vcftuples(raw, [ARGDICT])[0]
+    report_vcftuple(result)
+    return(result["vcf_tuple"])
 
 def process_segment(vcf_tuple, scaffy, beg):
     """Retrives allele counts within a genomic window"""
@@ -747,11 +1438,23 @@ def process_segment(vcf_tuple, scaffy, beg):
                     segment_spls[spl]["averages"] += spl_value
     return(segment_spls)
 
+def fast_windows(positions, values, begs, window, min_allele):
+    """Averages sorted SNP values in many windows at once using cumulative sums"""
+    present = ~np.isnan(values)
+    sums = np.concatenate(([0.0], np.cumsum(np.where(present, values, 0.0))))
+    nsnps = np.concatenate(([0], np.cumsum(present)))
+    low = np.searchsorted(positions, begs, side="left")
+    high = np.searchsorted(positions, begs + window, side="right")
+    counts = nsnps[high] - nsnps[low]
+    means = np.full(len(begs), np.nan)
+    enough = (counts >= min_allele) & (counts > 0)
+    means[enough] = (sums[high] - sums[low])[enough]/counts[enough]
+    return(means, counts)
+
 def slider(vcf_tuple):
     """Performs a sliding window analysis"""
     print("RUNNING SLIDING WINDOW ANALYSIS")
-    shader = scale_dict(ARGDICT["outdir1"] + "/chrom_file.txt")[0]
-    lennies = length_dict(ARGDICT["outdir1"] + "/chrom_file.txt")
+    genome = genome_index()
     outdict = {}
     for spl in vcf_tuple[2]:
         outdict[spl] = {}
@@ -760,8 +1463,8 @@ def slider(vcf_tuple):
         outdict[spl]["nvr"] = []
     for scaffy in vcf_tuple[1]:
         beg = 0
-        medpos = mean([beg, beg+ARGDICT["window"]])+shader[scaffy]
-        while (beg+ARGDICT["window"]) <= (lennies[scaffy] + ARGDICT["slide"]):
+        medpos = mean([beg, beg+ARGDICT["window"]])+genome.offset(scaffy)
+        while (beg+ARGDICT["window"]) <= (genome.length(scaffy) + ARGDICT["slide"]):
             segment_spls = process_segment(vcf_tuple, scaffy, beg)
             for spl in segment_spls:
                 if segment_spls[spl]["count"] >= ARGDICT["min_allele"]:
@@ -770,7 +1473,8 @@ def slider(vcf_tuple):
                     outdict[spl]["pos"].append(medpos)
                     outdict[spl]["nvr"].append(int(segment_spls[spl]["count"]))
             beg = beg + ARGDICT["slide"]
-            medpos = mean([beg, beg + ARGDICT["window"]]) + shader[scaffy]
+            medpos = mean([beg, beg + ARGDICT["window"]]) + genome.offset(scaffy)
+    count_units("windows", sum(len(outdict[spl]["pos"]) for spl in outdict))
     outdir2 = ARGDICT["outdir2"]
     if not os.path.isdir("%s"%ARGDICT["outdir2"]):
         subprocess.call("mkdir %s"%(outdir2), shell=True)
@@ -789,16 +1493,11 @@ def slider(vcf_tuple):
 
 def shade_grid(axes, maxx):
     """Shades chromosomes in alternating gray and white"""
-    shader_file = ARGDICT["outdir1"] + "/chrom_file.txt"
-    shade_scaff_line = scale_dict(shader_file)
-    shader = shade_scaff_line[0]
-    scaffolds = shade_scaff_line[1]
     # here comes the shading of scaffolds/chroms
     old = None
     shade = False
     # here comes the shading
-    for contig in scaffolds:
-        val = shader[contig]
+    for val in genome_index().offsets.tolist():
         if old and shade:
             axes.axvspan(old, val, color='0.87', alpha=0.5)
             shade = False
@@ -942,85 +1641,47 @@ def ticks(axes, x_min, x_max, y_min, y_max):
     axes.set_yticklabels(tick_def[1], size=17.24)
     axes.tick_params(axis="both", which="both", top=True, right=True)
 
-def finish_plot(axes, indict, fig, commas):
-    """Adds the option to zoom in on parts of plot"""
-    all_spls = sorted(indict)
-    if "nvr" in indict[all_spls[0]]:
-        plot_file = ARGDICT["outdir3"] + "/BSA_sep_plot.pdf"
-        axes.set_ylabel("Selected parent allele frequency", size=17.24)
-    elif commas:
-        plot_file = ARGDICT["outdir3"] + "/BSA_comb_plot.pdf"
-        axes.set_ylabel("Difference in allele frequency", size=17.24)
-    else:
-        plot_file = ARGDICT["outdir3"] + "/BSA_average_plot.pdf"
-        axes.set_ylabel("Difference in allele frequency", size=17.24)
-    print("Saving plot to %s"%(plot_file))
-    print("***********************")
-    fig.savefig(plot_file, bbox_inches='tight')
-    if "zoom_file" in ARGDICT:
-        converta = scale_dict(ARGDICT["outdir1"] + "/chrom_file.txt")[0]
-        zoomy = open(ARGDICT["zoom_file"])
-        for line in zoomy:
-            line = line.rstrip().split("\t")
-            chrom = line[0]
-            beg = int(line[1])+converta[chrom]
-            end = int(line[2])+converta[chrom]
-            y_min = 1
-            y_max = 0
-            for spl in all_spls:
-                posses = [p for p in indict[spl]["pos"] if beg <= p <= end]
-                where_beg = indict[spl]["pos"].index(posses[0])
-                where_end = indict[spl]["pos"].index(posses[-1])
-                values = indict[spl]["val"][where_beg:where_end]
-                y_max = max(values) if max(values) > y_max else y_max
-                y_min = min(values) if min(values) < y_min else y_min
-            if "stat_cutoff" in ARGDICT:
-                axes.axhline(y=ARGDICT["stat_cutoff"],
-                             ls="dashed", lw=1, color=ARGDICT["sigcolor"])
-                axes.axhline(y=-ARGDICT["stat_cutoff"],
-                             ls="dashed", lw=1, color=ARGDICT["sigcolor"])
-                y_max = ARGDICT["stat_cutoff"] if ARGDICT["stat_cutoff"] > y_max else y_max
-                y_min = -ARGDICT["stat_cutoff"] if -ARGDICT["stat_cutoff"] < y_min else y_min
-            new_extremes = (y_min-abs(y_max-y_min)*0.05, y_max+abs(y_max-y_min)*0.05)
-            if "nvr" in indict[all_spls[0]]:
-                y_min = 0
-                y_max = 1
-            else:
-                y_min = new_extremes[0]
-                y_max = new_extremes[1]
-            ticks(axes, beg, end, y_min, y_max)
-            if "nvr" not in indict[all_spls[0]]:
-                axes.set_ylim(y_min, y_max)
-            else:
-                axes.set_ylim(-0.02, 1.02)
-            axes.set_xlim(beg, end)
-            new_plotfile = ARGDICT["outdir3"]+"/%s_%s_%s_%s.pdf"%(
-                plot_file.split("/")[-1].split(".")[0], chrom, beg, end)
-            print("Saving plot to %s"%(new_plotfile))
-            print("***********************")
-            fig.savefig(new_plotfile, bbox_inches='tight')
+def plot_columns(axes, fig):
+    """Number of pixel columns the axes take up in the saved figure"""
+    return(max(1, int(fig.get_figwidth()*fig.dpi*axes.get_position().width)))
+
+def decimate(positions, values, x_min, x_max, ncols):
+    """Keeps the first, lowest, highest and last point of each pixel column"""
+    positions = np.asarray(positions, dtype=float)
+    values = np.asarray(values, dtype=float)
+    inside = np.flatnonzero((positions >= x_min) & (positions <= x_max))
+    if "full_resolution" in ARGDICT or len(inside) <= 4*ncols:
+        return(positions[inside], values[inside])
+    cols = ((positions[inside]-x_min)/float(x_max-x_min)*ncols).astype(int)
+    firsts = np.flatnonzero(np.concatenate(([True], np.diff(cols) != 0)))
+    lasts = np.concatenate((firsts[1:]-1, [len(cols)-1]))
+    # sorting on value within each column puts its minimum first and maximum last
+    by_value = np.lexsort((values[inside], cols))
+    keep = np.unique(np.concatenate((firsts, lasts, by_value[firsts], by_value[lasts])))
+    return(positions[inside[keep]], values[inside[keep]])
+
+def plot_series(indict, beg=None, end=None):
+    """Copies the windows to plot, keeping only those between beg and end"""
+    outdict = {}
+    for spl in indict:
+        where_beg = 0 if beg is None else bisect_left(indict[spl]["pos"], beg)
+        where_end = len(indict[spl]["pos"]) if end is None else bisect_right(
+            indict[spl]["pos"], end)
+        outdict[spl] = {"pos": indict[spl]["pos"][where_beg:where_end],
+                        "val": indict[spl]["val"][where_beg:where_end]}
+        if "perm" in indict[spl]:
+            outdict[spl]["perm"] = indict[spl]["perm"]
+        if "nvr" in indict[spl]:
+            outdict[spl]["nvr"] = True
+    return(outdict)
 
-def plotter(indict):
-    """Uses matplotlib to plot BSA scans"""
-    ## FILES TO PLOT
-    fig = plt.figure(figsize=(15, 5), dpi=1500)
-    axes = plt.axes()
-    print("***********************")
-    print("PLOTTIN'")
-    chrom_tuple = scale_ends(ARGDICT["outdir1"] + "/chrom_file.txt")
-    if not os.path.isdir("%s"%ARGDICT["outdir3"]):
-        subprocess.call("mkdir %s"%(ARGDICT["outdir3"]), shell=True)
-    chrom_dict = chrom_tuple[0]
-    chroms = chrom_tuple[1]
-    x_min = 0
-    x_max = chrom_dict[chroms[-1]]
-    y_min = 1
-    y_max = 0
-    axes.axhline(y=0, ls="solid", lw=0.5, color="black")
-    commas = None
+def plot_styles(indict, show=True):
+    """Picks the color and line width of each sample and prints them"""
+    styles = {}
     all_spls = sorted(indict)
     if ARGDICT["color"][0] != "custom":
         linespace = [0.01]+afill(0.01, 0.99, len(all_spls)-2)+[0.99]
+        plt = pyplot()
         alterna = "plt.cm.%s(%s)"%(ARGDICT["color"], linespace)
         list_alt = list(eval(alterna))
         iter_alt = iter(list_alt)
@@ -1032,49 +1693,340 @@ def plotter(indict):
             list_alt = ARGDICT["color"][1:]
             iter_alt = iter(list_alt)
     for spl in all_spls:
-        commas = True if "," in spl else False
-        x_max = max(indict[spl]["pos"]) if max(indict[spl]["pos"]) > x_max else x_max
-        x_min = min(indict[spl]["pos"]) if min(indict[spl]["pos"]) < x_min else x_min
-        y_max = max(indict[spl]["val"]) if max(indict[spl]["val"]) > y_max else y_max
-        y_min = min(indict[spl]["val"]) if min(indict[spl]["val"]) < y_min else y_min
         if "," in spl or spl == "average" or "perm" in indict[spl]:
             tsvet = next(iter_alt)
             linew = 1.5 if "," in spl or spl == "average" or "plot" in ARGDICT else 1
         else:
             tsvet = list_alt[1] if spl in ARGDICT["selected_offspring"] else list_alt[-2]
             linew = 1
+        if show and ARGDICT["color"][0] != "custom":
+            print("%s : %s" %(mpl_colors().to_hex(tsvet), spl))
+        elif show:
+            print("%s : %s" %(tsvet, spl))
+        styles[spl] = (tsvet, linew)
+    return(styles)
+
+def render_plot(task):
+    """Draws and saves one genome-wide or zoomed in plot"""
+    indict, styles, plot_file, region, cutoff = task
+    plt = pyplot()
+    fig = plt.figure(figsize=(15, 5), dpi=ARGDICT["dpi"])
+    axes = plt.axes()
+    all_spls = sorted(indict)
+    x_min = 0
+    x_max = genome_index().size
+    for spl in all_spls:
+        if len(indict[spl]["pos"]):
+            x_max = max(x_max, np.max(indict[spl]["pos"]))
+            x_min = min(x_min, np.min(indict[spl]["pos"]))
+    shade_grid(axes, x_max)
+    if region:
+        x_min = region[0]
+        x_max = region[1]
+    y_min = 1
+    y_max = 0
+    axes.axhline(y=0, ls="solid", lw=0.5, color="black")
+    for spl in all_spls:
+        tsvet, linew = styles[spl]
+        if len(indict[spl]["val"]):
+            y_max = max(y_max, np.max(indict[spl]["val"]))
+            y_min = min(y_min, np.min(indict[spl]["val"]))
         if "perm" in indict[spl]:
             y_max = indict[spl]["perm"] if indict[spl]["perm"] > y_max else y_max
             y_min = -indict[spl]["perm"] if -indict[spl]["perm"] < y_min else y_min
             axes.axhline(y=-indict[spl]["perm"], ls="dashed", lw=1, color=tsvet)
             axes.axhline(y=indict[spl]["perm"], ls="dashed", lw=1, color=tsvet)
-        if ARGDICT["color"][0] != "custom":
-            print("%s : %s" %(matplotlib.colors.to_hex(tsvet), spl))
-        else:
-            print("%s : %s" %(tsvet, spl))
-        axes.plot(indict[spl]["pos"], indict[spl]["val"], lw=linew, color=tsvet)
-    if "stat_cutoff" in ARGDICT:
-        axes.axhline(y=ARGDICT["stat_cutoff"], ls="dashed", lw=1, color=ARGDICT["sigcolor"])
-        axes.axhline(y=-ARGDICT["stat_cutoff"], ls="dashed", lw=1, color=ARGDICT["sigcolor"])
-        y_max = ARGDICT["stat_cutoff"] if ARGDICT["stat_cutoff"] > y_max else y_max
-        y_min = -ARGDICT["stat_cutoff"] if -ARGDICT["stat_cutoff"] < y_min else y_min
+        axes.plot(*decimate(indict[spl]["pos"], indict[spl]["val"], x_min, x_max,
+                            plot_columns(axes, fig)), lw=linew, color=tsvet,
+                  rasterized="rasterize" in ARGDICT)
+    if cutoff:
+        axes.axhline(y=cutoff, ls="dashed", lw=1, color=ARGDICT["sigcolor"])
+        axes.axhline(y=-cutoff, ls="dashed", lw=1, color=ARGDICT["sigcolor"])
+        y_max = cutoff if cutoff > y_max else y_max
+        y_min = -cutoff if -cutoff < y_min else y_min
     # ACCESSORY STUFF TO MAKE IT PRETTY
-    shade_grid(axes, x_max)
-    new_extremes = (y_min-abs(y_max-y_min)*0.05, y_max+abs(y_max-y_min)*0.05)
-    if "nvr" not in indict[all_spls[0]]:
-        y_min = new_extremes[0]
-        y_max = new_extremes[1]
-    else:
-        y_min = 0
-        y_max = 1
-    ticks(axes, x_min, x_max, y_min, y_max)
-    # HOW FAR WILL THE PLOT GO?
-    if "nvr" not in indict[all_spls[0]]:
-        axes.set_ylim(y_min, y_max)
-    else:
+    if "nvr" in indict[all_spls[0]]:
+        axes.set_ylabel("Selected parent allele frequency", size=17.24)
+        ticks(axes, x_min, x_max, 0.0, 1.0)
         axes.set_ylim(-0.02, 1.02)
+    else:
+        axes.set_ylabel("Difference in allele frequency", size=17.24)
+        new_extremes = (y_min-abs(y_max-y_min)*0.05, y_max+abs(y_max-y_min)*0.05)
+        ticks(axes, x_min, x_max, new_extremes[0], new_extremes[1])
+        axes.set_ylim(new_extremes[0], new_extremes[1])
     axes.set_xlim(x_min, x_max)
-    finish_plot(axes, indict, fig, commas)
+    with plt.rc_context(PLOT_RC):
+        fig.savefig(plot_file, bbox_inches='tight', dpi=ARGDICT["dpi"])
+    plt.close(fig)
+
+def plotter(indict):
+    """Queues the plot of a BSA scan and of each region in the zoom file"""
+    if "noplot" in ARGDICT:
+        return
+    print("***********************")
+    print("PLOTTIN'")
+    if not os.path.isdir("%s"%ARGDICT["outdir3"]):
+        subprocess.call("mkdir %s"%(ARGDICT["outdir3"]), shell=True)
+    all_spls = sorted(indict)
+    styles = plot_styles(indict)
+    if "nvr" in indict[all_spls[0]]:
+        plot_file = ARGDICT["outdir3"] + "/BSA_sep_plot.%s"%(ARGDICT["plot_format"])
+    elif "," in all_spls[-1]:
+        plot_file = ARGDICT["outdir3"] + "/BSA_comb_plot.%s"%(ARGDICT["plot_format"])
+    else:
+        plot_file = ARGDICT["outdir3"] + "/BSA_average_plot.%s"%(ARGDICT["plot_format"])
+    # the cutoff is taken now, since the plot is drawn later in the run,
+    # and it does not apply to the allele frequencies of single samples
+    cutoff = None if "nvr" in indict[all_spls[0]] else ARGDICT.get("stat_cutoff")
+    PLOT_QUEUE.append((plot_series(indict), styles, plot_file, None, cutoff))
+    if "zoom_file" in ARGDICT:
+        zoomy = open(ARGDICT["zoom_file"])
+        regions = []
+        for line in zoomy:
+            # a peaks.bed lists a region once for every series it was called on
+            region = line.rstrip().split("\t")[:3]
+            if line[0] != "#" and region not in regions:
+                regions.append(region)
+        zoomy.close()
+        chroms = [region[0] for region in regions]
+        begs = genome_index().to_global(chroms, [int(float(region[1])) for region in regions])
+        ends = genome_index().to_global(chroms, [int(float(region[2])) for region in regions])
+        for chrom, beg, end in zip(chroms, begs.tolist(), ends.tolist()):
+            new_plotfile = ARGDICT["outdir3"]+"/%s_%s_%s_%s.%s"%(
+                plot_file.split("/")[-1].split(".")[0], chrom, beg, end, ARGDICT["plot_format"])
+            # each zoomed in plot only gets the windows it shows
+            PLOT_QUEUE.append((plot_series(indict, beg, end), styles, new_plotfile,
+                               (beg, end), cutoff))
+
+def render_plots():
+    """Draws all queued plots, several at a time"""
+    tasks = PLOT_QUEUE[:]
+    del PLOT_QUEUE[:]
+    if tasks:
+        profiled("plots", draw_plots, tasks)
+
+def draw_plots(tasks):
+    """Draws the given plots, several at a time"""
+    for task in tasks:
+        print("Saving plot to %s"%(task[2]))
+    print("***********************")
+    count_units("plots", len(tasks))
+    if ARGDICT["plot_threads"] > 1 and len(tasks) > 1:
+        pool = worker_pool(min(ARGDICT["plot_threads"], len(tasks)))
+        pool.map(render_plot, tasks, chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        for task in tasks:
+            render_plot(task)
+
+TILE_BINS = 512 # bins in one tile of the genome browser
+
+VIEWER_HTML = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>BSA scan</title>
+<style>
+body { margin: 0; font: 13px sans-serif; }
+canvas { display: block; width: 100%; height: 420px; cursor: grab; }
+#info { padding: 4px 8px; color: #444; }
+</style>
+</head>
+<body>
+<canvas id="scan"></canvas>
+<div id="info">Scroll to zoom, drag to pan, double click to reset</div>
+<script>
+var META = null, TILES = {}, ASKED = {}, VIEW = null, DRAG = null;
+function bsaMeta(meta) { META = meta; }
+function bsaTile(level, tile, data) { TILES[level + "_" + tile] = data; draw(); }
+function level() {
+    var want = META.length * CANVAS.width / ((VIEW[1] - VIEW[0]) * META.bins);
+    var lev = Math.ceil(Math.log(Math.max(want, 1)) / Math.LN2);
+    return Math.max(0, Math.min(META.levels, lev));
+}
+function ask(lev, tile) {
+    var key = lev + "_" + tile;
+    if (ASKED[key]) { return; }
+    ASKED[key] = true;
+    var script = document.createElement("script");
+    script.src = "tiles/" + key + ".js";
+    script.onerror = function () { TILES[key] = {}; };
+    document.body.appendChild(script);
+}
+function draw() {
+    var ctx = CANVAS.getContext("2d"), wide = CANVAS.width, high = CANVAS.height;
+    var span = VIEW[1] - VIEW[0];
+    var xpix = function (x) { return (x - VIEW[0]) / span * wide; };
+    var ypix = function (y) { return high - 25 - (y - META.ymin) / (META.ymax - META.ymin) * (high - 35); };
+    ctx.clearRect(0, 0, wide, high);
+    ctx.font = "12px sans-serif";
+    META.chroms.forEach(function (chrom, ix) {
+        var beg = xpix(chrom[1]), end = xpix(chrom[1] + chrom[2]);
+        if (end < 0 || beg > wide) { return; }
+        if (ix % 2) { ctx.fillStyle = "rgba(222,222,222,0.5)"; ctx.fillRect(beg, 0, end - beg, high - 25); }
+        ctx.fillStyle = "#000";
+        ctx.fillText(chrom[0], Math.max(beg, 0) + 3, high - 8);
+    });
+    ctx.strokeStyle = "#000";
+    ctx.beginPath(); ctx.moveTo(0, ypix(0)); ctx.lineTo(wide, ypix(0)); ctx.stroke();
+    if (META.cutoff) {
+        ctx.setLineDash([6, 4]);
+        ctx.strokeStyle = META.sigcolor;
+        [META.cutoff, -META.cutoff].forEach(function (y) {
+            ctx.beginPath(); ctx.moveTo(0, ypix(y)); ctx.lineTo(wide, ypix(y)); ctx.stroke();
+        });
+        ctx.setLineDash([]);
+    }
+    var lev = level(), binw = META.length / (META.bins * Math.pow(2, lev));
+    var first = Math.max(0, Math.floor(VIEW[0] / (binw * META.bins)));
+    var last = Math.min(Math.pow(2, lev) - 1, Math.floor(VIEW[1] / (binw * META.bins)));
+    META.series.forEach(function (series) {
+        ctx.fillStyle = series.color;
+        ctx.strokeStyle = series.color;
+        ctx.globalAlpha = 0.35;
+        for (var tile = first; tile <= last; tile++) {
+            var data = TILES[lev + "_" + tile];
+            if (!data) { ask(lev, tile); continue; }
+            if (!data[series.name]) { continue; }
+            var mins = data[series.name][0], maxs = data[series.name][1];
+            for (var bin = 0; bin < META.bins; bin++) {
+                if (mins[bin] === null) { continue; }
+                var x = xpix((tile * META.bins + bin) * binw);
+                var top = ypix(maxs[bin]);
+                ctx.fillRect(x, top, Math.max(1, binw / span * wide), Math.max(1, ypix(mins[bin]) - top));
+            }
+        }
+        ctx.globalAlpha = 1;
+        ctx.beginPath();
+        var started = false;
+        for (var tile = first; tile <= last; tile++) {
+            var data = TILES[lev + "_" + tile];
+            if (!data || !data[series.name]) { started = false; continue; }
+            var means = data[series.name][2];
+            for (var bin = 0; bin < META.bins; bin++) {
+                if (means[bin] === null) { started = false; continue; }
+                var x = xpix((tile * META.bins + bin + 0.5) * binw);
+                if (started) { ctx.lineTo(x, ypix(means[bin])); }
+                else { ctx.moveTo(x, ypix(means[bin])); started = true; }
+            }
+        }
+        ctx.stroke();
+    });
+}
+function where(x) {
+    for (var ix = META.chroms.length - 1; ix >= 0; ix--) {
+        if (x >= META.chroms[ix][1]) { return META.chroms[ix][0] + ":" + Math.round(x - META.chroms[ix][1]); }
+    }
+    return "";
+}
+var CANVAS = document.getElementById("scan");
+function resize() { CANVAS.width = CANVAS.clientWidth; CANVAS.height = CANVAS.clientHeight; draw(); }
+function clamp() {
+    var span = Math.min(VIEW[1] - VIEW[0], META.length);
+    VIEW[0] = Math.max(0, Math.min(VIEW[0], META.length - span));
+    VIEW[1] = VIEW[0] + span;
+}
+CANVAS.addEventListener("wheel", function (event) {
+    event.preventDefault();
+    var at = VIEW[0] + event.offsetX / CANVAS.width * (VIEW[1] - VIEW[0]);
+    var scale = event.deltaY < 0 ? 0.8 : 1.25;
+    var span = Math.max((VIEW[1] - VIEW[0]) * scale, META.resolution * 10);
+    VIEW = [at - (at - VIEW[0]) / (VIEW[1] - VIEW[0]) * span, 0];
+    VIEW[1] = VIEW[0] + span;
+    clamp(); draw();
+});
+CANVAS.addEventListener("mousedown", function (event) { DRAG = [event.offsetX, VIEW[0], VIEW[1]]; });
+window.addEventListener("mouseup", function () { DRAG = null; });
+CANVAS.addEventListener("mousemove", function (event) {
+    var span = VIEW[1] - VIEW[0];
+    if (DRAG) {
+        var shift = (DRAG[0] - event.offsetX) / CANVAS.width * span;
+        VIEW = [DRAG[1] + shift, DRAG[2] + shift];
+        clamp(); draw();
+    }
+    document.getElementById("info").textContent = where(VIEW[0] + event.offsetX / CANVAS.width * span);
+});
+CANVAS.addEventListener("dblclick", function () { VIEW = [0, META.length]; draw(); });
+window.addEventListener("resize", resize);
+</script>
+<script src="meta.js"></script>
+<script>
+document.title = META.title;
+VIEW = [0, META.length];
+resize();
+</script>
+</body>
+</html>
+"""
+
+def tile_bins(positions, values, binw):
+    """Finds the lowest, highest and mean value of the windows in each bin"""
+    bins = (positions/binw).astype(int)
+    starts = np.flatnonzero(np.concatenate(([True], np.diff(bins) != 0)))
+    counts = np.diff(np.concatenate((starts, [len(bins)])))
+    return(bins[starts], np.minimum.reduceat(values, starts),
+           np.maximum.reduceat(values, starts), np.add.reduceat(values, starts)/counts)
+
+def write_tiles(indict):
+    """Writes the window series as tiles at several zoom levels with an HTML viewer"""
+    tile_dir = ARGDICT["outdir3"] + "/viewer"
+    print("WRITING VIEWER TILES TO %s"%(tile_dir))
+    if not os.path.isdir(tile_dir + "/tiles"):
+        os.makedirs(tile_dir + "/tiles")
+    contigs = genome_index()
+    genome = contigs.size
+    series = {}
+    for spl in sorted(indict):
+        # a series without windows has nothing to show
+        if len(indict[spl]["pos"]):
+            series[spl] = (np.asarray(indict[spl]["pos"], dtype=float),
+                           np.asarray(indict[spl]["val"], dtype=float))
+    # the finest level has about one bin per window, or per slide if no series has two
+    steps = [np.median(np.diff(series[spl][0])) for spl in series if len(series[spl][0]) > 1]
+    resolution = min(steps) if steps else ARGDICT["slide"]
+    levels = max(0, int(math.ceil(math.log(genome/(TILE_BINS*resolution), 2))))
+    ntiles = 0
+    for level in range(levels+1):
+        binw = genome/float(TILE_BINS*2**level)
+        tiles = {}
+        for spl in series:
+            bins, mins, maxs, means = tile_bins(series[spl][0], series[spl][1], binw)
+            tile_ix = bins//TILE_BINS
+            bounds = np.flatnonzero(np.concatenate(([True], np.diff(tile_ix) != 0, [True])))
+            for beg, end in zip(bounds[:-1], bounds[1:]):
+                stats = []
+                for stat in (mins, maxs, means):
+                    binned = np.full(TILE_BINS, np.nan)
+                    binned[bins[beg:end] % TILE_BINS] = np.round(stat[beg:end], 4)
+                    stats.append([None if np.isnan(val) else val for val in binned.tolist()])
+                tiles.setdefault(int(tile_ix[beg]), {})[spl] = stats
+        for tile in tiles:
+            with open("%s/tiles/%s_%s.js"%(tile_dir, level, tile), "w") as tile_out:
+                tile_out.write("bsaTile(%s, %s, %s);\n"%(level, tile, json.dumps(tiles[tile])))
+        ntiles += len(tiles)
+    styles = plot_styles(indict, show=False)
+    y_min = min([0] + [series[spl][1].min() for spl in series])
+    y_max = max([0] + [series[spl][1].max() for spl in series])
+    cutoff = ARGDICT.get("stat_cutoff")
+    if cutoff:
+        y_min = min(y_min, -cutoff)
+        y_max = max(y_max, cutoff)
+    meta = {"title": "BSA scan of %s"%(os.path.basename(ARGDICT.get("vcf") or "plotted files")),
+            "length": genome, "bins": TILE_BINS, "levels": levels,
+            "resolution": float(resolution),
+            "ymin": y_min-abs(y_max-y_min)*0.05, "ymax": y_max+abs(y_max-y_min)*0.05,
+            "cutoff": cutoff, "sigcolor": mpl_colors().to_hex(ARGDICT["sigcolor"]),
+            "chroms": [[chrom, contigs.offset(chrom), contigs.length(chrom)]
+                       for chrom in contigs.names],
+            "series": [{"name": spl, "color": mpl_colors().to_hex(styles[spl][0])}
+                       for spl in sorted(series)]}
+    with open(tile_dir + "/meta.js", "w") as meta_out:
+        meta_out.write("bsaMeta(%s);\n"%(json.dumps(meta)))
+    with open(tile_dir + "/index.html", "w") as html_out:
+        html_out.write(VIEWER_HTML)
+    print("%s tiles over %s zoom levels; open %s/index.html in a browser"%(
+        ntiles, levels+1, tile_dir))
 
 def plot_perm(filey):
     """Loads permutation information from file to plot"""
@@ -1087,21 +2039,31 @@ def plot_perm(filey):
             cutoff = current
     return(cutoff)
 
+def load_windows(filey):
+    """Reads the positions and values of a window file in one go"""
+    binary = os.path.splitext(filey)[0] + ".npy"
+    if filey.endswith(".npy"):
+        windows = np.load(filey)
+    elif os.path.isfile(binary) and os.path.getmtime(binary) >= os.path.getmtime(filey):
+        windows = np.load(binary)
+    else:
+        windows = np.loadtxt(filey, delimiter="\t", usecols=(0, 1), ndmin=2).T
+    return(windows[0], windows[1])
+
 def plot_dict():
     """Loads sliding window information to plot"""
     outplot_dict = {}
+    pool = ThreadPool(processes=max(1, min(ARGDICT["plot_threads"], len(ARGDICT["plot"]))))
+    loaded = pool.map(load_windows, ARGDICT["plot"])
+    pool.close()
+    pool.join()
     for filey in enumerate(ARGDICT["plot"]):
         outplot_dict["%s,%s"%(filey[0], filey[1])] = {}
-        outplot_dict["%s,%s"%(filey[0], filey[1])]["pos"] = []
-        outplot_dict["%s,%s"%(filey[0], filey[1])]["val"] = []
+        outplot_dict["%s,%s"%(filey[0], filey[1])]["pos"] = loaded[filey[0]][0]
+        outplot_dict["%s,%s"%(filey[0], filey[1])]["val"] = loaded[filey[0]][1]
         if "permplot" in ARGDICT:
             outplot_dict["%s,%s"%(filey[0], filey[1])]["perm"] = plot_perm(
                 ARGDICT["permplot"][filey[0]])
-        openfile = open(filey[1])
-        for line in openfile:
-            line = line.rstrip().split("\t")
-            outplot_dict["%s,%s"%(filey[0], filey[1])]["pos"].append(float(line[0]))
-            outplot_dict["%s,%s"%(filey[0], filey[1])]["val"].append(float(line[1]))
     return(outplot_dict)
 
 def lowest_highest(indict):
@@ -1171,9 +2133,7 @@ def fill_in(indict):
      for permutations"""
     print("FILLING MISSING VALUES")
     outdict = {}
-    chrom_tuple = scale_ends(ARGDICT["outdir1"] + "/chrom_file.txt")
-    chrom_dict = chrom_tuple[0]
-    chroms = chrom_tuple[1]
+    genome = genome_index()
     for spl in indict:
         outdict[spl] = {}
         outdict[spl]["pos"] = []
@@ -1186,10 +2146,10 @@ def fill_in(indict):
         # identify gaps in windows and fill them
         outdict = fill_loop(indict, outdict, spl, positions)
         # final fill
-        diff = chrom_dict[chroms[-1]]-lo_hi[1]
+        diff = genome.size-lo_hi[1]
         end_fills = 0
         if diff > ARGDICT["slide"]:
-            fills = arange(lo_hi[1]+ARGDICT["slide"], chrom_dict[chroms[-1]], ARGDICT["slide"])
+            fills = arange(lo_hi[1]+ARGDICT["slide"], genome.size, ARGDICT["slide"])
             end_fills = len(fills)
             outdict[spl]["pos"] = outdict[spl]["pos"]+fills
         diff = lo_hi[0]-(ARGDICT["slide"])
@@ -1218,44 +2178,488 @@ def fill_in(indict):
                 "%s\t%s\t%s\n" %
                 (possa, outdict[spl]["val"][where], outdict[spl]["nvr"][where]))
         bsa_out.close()
+    count_units("windows", sum(len(outdict[spl]["pos"]) for spl in outdict))
     return(outdict)
 
-def permute_shuffle(new_permute_dict):
-    """Performs sliding permutations on replicates"""
-    permuted_values = []
-    # do i need this variable?
-    ngrps = float(len(new_permute_dict))
-    for grp in new_permute_dict:
-        vals = new_permute_dict[grp]["val"]
-        nvals = len(vals)
-        where = random.randint(0, nvals)
-        permvals = vals[where:] + vals[:where]
-        if not permuted_values:
-            permuted_values = permvals
+def shifted_means(vals, wheres, columns):
+    """Averages replicates slid by the given offsets at the given windows"""
+    nvals = vals.shape[1]
+    permuted = np.zeros((wheres.shape[0], len(columns)))
+    for ix_grp in range(vals.shape[0]):
+        permuted += vals[ix_grp][(columns + wheres[:, ix_grp][:, None]) % nvals]
+    return(np.abs(permuted/vals.shape[0]))
+
+def perm_block(ncols):
+    """Number of permutations per block that keeps the block array within PERM_BUDGET"""
+    return(max(1, PERM_BUDGET // max(1, ncols)))
+
+def draw_shifts(rng, nperm, ngrps, nvals):
+    """Draws the sliding offsets of each replicate for a block of permutations"""
+    return(np.array([[rng.randint(0, nvals) for _perm in range(nperm)]
+                     for _grp in range(ngrps)]).T)
+
+def count_perms(new_permute_dict, nperm):
+    """Adds finished permutations to the shared counter of their combination"""
+    if PERM_COUNTERS is not None:
+        # each combination is permuted by one worker, so counters are not locked
+        PERM_COUNTERS[ARGDICT["perm_slots"][";".join(sorted(new_permute_dict))]] += nperm
+
+def resumed_perms(new_permute_dict):
+    """Permutations of a combination that -resume takes from its checkpoint"""
+    ckpt_counts = ARGDICT["outdir1"]+"/checkpoints/perm_%s.cnt"%(null_key(new_permute_dict))
+    if "resume" not in ARGDICT or not os.path.isfile(ckpt_counts):
+        return(0)
+    nrun = load_counts(ckpt_counts)[1]
+    # permute_process discards a checkpoint of a larger -perm setting
+    return(nrun if nrun <= ARGDICT["perm"] else 0)
+
+def perm_progress(stage, dictlist, nperm, resumed=None):
+    """Makes counters for the workers and reports the permutations they finish"""
+    resumed = resumed or [0]*len(dictlist)
+    # the counters start at the permutations resumed from checkpoints
+    counters = multiprocessing.get_context(ARGDICT.get("start_method")).RawArray(
+        "q", resumed)
+    ARGDICT["perm_slots"] = dict((";".join(sorted(new_permute_dict)), ix)
+                                 for ix, new_permute_dict in enumerate(dictlist))
+    progress = Progress(stage, nperm*len(dictlist), "permutations", "permutations",
+                        sum(resumed))
+    progress.watch(lambda: (sum(counters), {"per_combination": ",".join(
+        str(count) for count in counters)}))
+    return(counters, progress)
+
+def permute_batch(new_permute_dict, nperm, rng=random):
+    """Performs a batch of sliding permutations on replicates"""
+    vals = np.array([new_permute_dict[grp]["val"] for grp in new_permute_dict], dtype=float)
+    nvals = vals.shape[1]
+    windows = np.arange(nvals)
+    observed = np.abs(ARGDICT["observed"])
+    topdists = np.empty(nperm)
+    counts = np.zeros(nvals, dtype=np.int64)
+    block = perm_block(nvals)
+    for beg in range(0, nperm, block):
+        nblock = min(block, nperm-beg)
+        permuted = shifted_means(vals, draw_shifts(rng, nblock, len(vals), nvals), windows)
+        topdists[beg:beg+nblock] = permuted.max(axis=1)
+        # how often each window is at least as extreme as observed
+        counts += (permuted >= observed).sum(axis=0)
+        count_perms(new_permute_dict, nblock)
+    return(topdists, counts)
+
+def permute_approx(new_permute_dict):
+    """Estimates the cutoff of a combination from permutations on a thinned window grid"""
+    outstring = ";".join(sorted(new_permute_dict))
+    vals = np.array([new_permute_dict[grp]["val"] for grp in new_permute_dict], dtype=float)
+    nvals = vals.shape[1]
+    # neighbouring windows share most of their SNPs, so one per window width is kept
+    stride = max(1, int(round(ARGDICT["window"]/float(ARGDICT["slide"]))))
+    thinned = np.arange(0, nvals, stride)
+    observed = np.abs(ARGDICT["observed"])
+    # calibration permutations are evaluated at full resolution and on the thinned grid
+    full_tops = []
+    thin_tops = []
+    counts = np.zeros(nvals, dtype=np.int64)
+    block = perm_block(nvals)
+    for beg in range(0, ARGDICT["approx_cal"], block):
+        nblock = min(block, ARGDICT["approx_cal"]-beg)
+        permuted = shifted_means(vals, draw_shifts(random, nblock, len(vals), nvals),
+                                 np.arange(nvals))
+        full_tops.extend(permuted.max(axis=1))
+        thin_tops.extend(permuted[:, thinned].max(axis=1))
+        counts += (permuted >= observed).sum(axis=0)
+        count_perms(new_permute_dict, nblock)
+    # thinning can only miss the maximum, never exceed it
+    correction = float(np.median(np.array(full_tops)/np.array(thin_tops)))
+    topdists = new_topdists()
+    topdists.extend(thin_tops)
+    block = perm_block(len(thinned))
+    for beg in range(len(topdists), ARGDICT["perm"], block):
+        nblock = min(block, ARGDICT["perm"]-beg)
+        permuted = shifted_means(vals, draw_shifts(random, nblock, len(vals), nvals), thinned)
+        topdists.extend(permuted.max(axis=1))
+        count_perms(new_permute_dict, nblock)
+    critical_vals = [dist_percentile(topdists, (1-sig)*100)*correction
+                     for sig in ARGDICT["sig_levels"]]
+    # on the calibration permutations, the exact and corrected cutoffs can be compared directly
+    difference = (np.percentile(thin_tops, (1-ARGDICT["sig"])*100)*correction
+                  - np.percentile(full_tops, (1-ARGDICT["sig"])*100))
+    print("%s: approximate critical value %s from %s permutations on every %sth window, "
+          "estimated difference from the exact value %s"%(
+              outstring, critical_vals[0], len(topdists), stride, difference))
+    with open(ARGDICT["outdir2"]+"/permutations.txt", "a") as perm_out:
+        perm_out.write("%s\t%s\tapprox\t%s\t%s\t%s\n"%(outstring, critical_vals[0],
+                                                       len(topdists), correction, difference))
+    return(outstring, null_key(new_permute_dict), len(topdists), critical_vals,
+           (counts, len(full_tops)))
+
+def load_counts(count_file):
+    """Loads window exceedance counts, the number of permutations and any quantile sketch"""
+    if count_file and os.path.isfile(count_file):
+        with open(count_file, "rb") as opencount:
+            saved = np.load(opencount)
+            sketch = saved["sketch"] if "sketch" in saved.files else None
+            return(saved["counts"], int(saved["nperm"]), sketch)
+    return(np.zeros(len(ARGDICT["observed"]), dtype=np.int64), 0, None)
+
+def save_counts(count_file, counts, ncounted, sketch=None):
+    """Saves window exceedance counts together with the number of permutations"""
+    arrays = {"counts":counts, "nperm":ncounted}
+    if sketch is not None:
+        arrays["sketch"] = sketch.counts
+    with open(count_file+".tmp", "wb") as count_out:
+        np.savez(count_out, **arrays)
+    os.rename(count_file+".tmp", count_file)
+
+class QuantileSketch(object):
+    """Mergeable fixed-resolution histogram of permutation maxima between 0 and 1
+
+    Memory does not grow with the number of permutations, and every
+    order statistic it returns is within half a bin of the exact one.
+    """
+    def __init__(self, resolution, counts=None):
+        self.resolution = resolution
+        if counts is None:
+            counts = np.zeros(int(math.ceil(1/resolution))+1, dtype=np.int64)
+        self.counts = np.array(counts, dtype=np.int64)
+
+    def __len__(self):
+        return(int(self.counts.sum()))
+
+    def __getitem__(self, rank):
+        """Value of the rank-th smallest permutation maximum"""
+        where = np.searchsorted(np.cumsum(self.counts), rank, side="right")
+        return((where + 0.5)*self.resolution)
+
+    def extend(self, values):
+        """Adds permutation maxima to the sketch"""
+        where = np.minimum((np.asarray(values)/self.resolution).astype(int), len(self.counts)-1)
+        self.counts += np.bincount(where, minlength=len(self.counts))
+
+    def merge(self, other):
+        """Adds the counts of another sketch with the same resolution"""
+        self.counts += other.counts
+
+    def percentile(self, cutoff):
+        """Percentile with the same interpolation as numpy.percentile"""
+        rank = (len(self)-1)*cutoff/100.0
+        low = self[int(math.floor(rank))]
+        return(low + (self[int(math.ceil(rank))]-low)*(rank-math.floor(rank)))
+
+def new_topdists():
+    """Starts an empty collection of permutation maxima"""
+    if "sketch" in ARGDICT:
+        return(QuantileSketch(ARGDICT["sketch"]))
+    return([])
+
+def dist_percentile(topdists, cutoff):
+    """Percentile of permutation maxima held in a list or a sketch"""
+    if isinstance(topdists, QuantileSketch):
+        return(topdists.percentile(cutoff))
+    return(np.percentile(topdists, cutoff))
+
+def order_ci(sorted_vals, quant, zscore=1.959964):
+    """Confidence interval of a percentile from order statistics"""
+    nvals = len(sorted_vals)
+    spread = zscore*math.sqrt(nvals*quant*(1-quant))
+    low_ix = int(math.floor(nvals*quant - spread)) - 1
+    high_ix = int(math.ceil(nvals*quant + spread)) - 1
+    if low_ix < 0 or high_ix > nvals - 1:
+        return(None)
+    return(sorted_vals[low_ix], sorted_vals[high_ix])
+
+def null_key(new_permute_dict):
+    """Identifies a combination by its window values and settings"""
+    hasher = hashlib.sha1()
+    hasher.update(("%s;%s;%s"%(ARGDICT["window"], ARGDICT["slide"],
+                               ARGDICT["min_allele"])).encode())
+    for grp in sorted(new_permute_dict):
+        hasher.update(grp.encode())
+        hasher.update(np.asarray(new_permute_dict[grp]["val"], dtype="<f8").tobytes())
+    return(hasher.hexdigest()[:16])
+
+def stored_nulls():
+    """Reads the index of stored null distributions"""
+    index = {}
+    if "null_dir" in ARGDICT and os.path.isfile(ARGDICT["null_dir"]+"/null_index.txt"):
+        with open(ARGDICT["null_dir"]+"/null_index.txt") as openindex:
+            for line in openindex:
+                line = line.rstrip().split("\t")
+                index[line[0]] = line[1]
+    return(index)
+
+def load_null(new_permute_dict):
+    """Loads the stored null distribution of a combination"""
+    key = null_key(new_permute_dict)
+    null_file = None
+    count_file = None
+    topdists = []
+    if "null_dir" in ARGDICT:
+        # earlier permutations of the same windows are reused and extended
+        null_file = ARGDICT["null_dir"]+"/%s.f8"%(key)
+        # window counts also depend on the observed average
+        count_file = ARGDICT["null_dir"]+"/%s_%s.cnt"%(
+            key, hashlib.sha1(np.asarray(ARGDICT["observed"], dtype="<f8")).hexdigest()[:16])
+        if os.path.isfile(null_file):
+            topdists = list(np.fromfile(null_file, dtype="<f8"))
+    counts, ncounted = load_counts(count_file)[:2]
+    return(key, null_file, topdists, count_file, counts, ncounted)
+
+def perm_summary(outstring, key, topdists, tallies, conf_int=None):
+    """Computes cutoffs of a combination and writes them to permutations.txt"""
+    if not topdists:
+        return(None)
+    critical_vals = [dist_percentile(topdists, (1-sig)*100) for sig in ARGDICT["sig_levels"]]
+    critical_val = critical_vals[0]
+    perm_out = open(ARGDICT["outdir2"]+"/permutations.txt", "a")
+    if "perm_tolerance" in ARGDICT:
+        if conf_int:
+            precision = (conf_int[1]-conf_int[0])/2.0
+            print("%s: %s permutations, critical value %s +/- %s"%(
+                outstring, len(topdists), critical_val, precision))
         else:
-            new_permuted_values = []
-            for permval in zip(permvals, permuted_values):
-                totes = sum(permval)
-                new_permuted_values.append(totes)
-            permuted_values = new_permuted_values
-    permuted_values = [i/ngrps for i in permuted_values]
-    tops = [abs(max(permuted_values)), abs(min(permuted_values))]
-    topdist = max(tops)
-    return(topdist)
+            conf_int = ("NA", "NA")
+            print("%s: %s permutations are too few to bound the critical value"%(
+                outstring, len(topdists)))
+        perm_out.write("%s\t%s\t%s\t%s\t%s\n"%(outstring, critical_val, len(topdists),
+                                              conf_int[0], conf_int[1]))
+    else:
+        perm_out.write("%s\t%s\n"%(outstring, critical_val))
+    perm_out.close()
+    return(outstring, key, len(topdists), critical_vals, tallies)
+
+def perm_ci(topdists):
+    """Confidence interval of the critical value in adaptive mode"""
+    if "perm_tolerance" not in ARGDICT or not topdists:
+        return(None)
+    if isinstance(topdists, QuantileSketch):
+        return(order_ci(topdists, 1-ARGDICT["sig"]))
+    return(order_ci(np.sort(topdists), 1-ARGDICT["sig"]))
 
 def permute_process(new_permute_dict):
     """Performs series of sliding permutations"""
-    perm_out = open(ARGDICT["outdir2"]+"/permutations.txt", "a")
-    topdists = []
-    for _perm in range(ARGDICT["perm"]):
-        topdist = permute_shuffle(new_permute_dict)
-        topdists.append(topdist)
-    cutoff = (1-ARGDICT["sig"])*100
-    critical_val = percentile(topdists, cutoff)
     outstring = ";".join(sorted(new_permute_dict))
-    perm_out.write("%s\t%s\n"%(outstring, critical_val))
+    key, null_file, topdists, count_file, counts, ncounted = load_null(new_permute_dict)
+    nstored = len(topdists)
+    maxperm = nstored + ARGDICT["perm"]
+    # finished batches are checkpointed so that an interrupted run can resume
+    ckpt_file = ARGDICT["outdir1"]+"/checkpoints/perm_%s.f8"%(key)
+    ckpt_counts = ARGDICT["outdir1"]+"/checkpoints/perm_%s.cnt"%(key)
+    run_counts, nrun, run_sketch = load_counts(ckpt_counts if "resume" in ARGDICT else None)
+    if nrun > ARGDICT["perm"]:
+        # a checkpoint of a larger -perm setting cannot be truncated with its counts
+        print("DISCARDING %s CHECKPOINTED PERMUTATIONS OF %s"%(nrun, outstring))
+        run_counts, nrun, run_sketch = load_counts(None)
+    if nrun:
+        print("RESUMING %s FROM %s PERMUTATIONS"%(outstring, nrun))
+    if "sketch" in ARGDICT:
+        # a sketch is checkpointed together with the counts
+        topdists = QuantileSketch(ARGDICT["sketch"], run_sketch)
+    else:
+        # counts are saved after the permutations, so they mark the last complete batch
+        done = np.fromfile(ckpt_file, dtype="<f8")[:nrun] if nrun else np.empty(0)
+        done.tofile(ckpt_file)
+        topdists = topdists + list(done)
+    conf_int = perm_ci(topdists)
+    # adaptive mode stops early once the critical value is precise enough
+    while (len(topdists) < maxperm
+           and not (conf_int and (conf_int[1]-conf_int[0])/2.0
+                    <= ARGDICT["perm_tolerance"])):
+        nbatch = min(ARGDICT["perm_batch"], maxperm-len(topdists))
+        batch, batch_counts = permute_batch(new_permute_dict, nbatch)
+        topdists.extend(batch)
+        if "sketch" not in ARGDICT:
+            with open(ckpt_file, "ab") as ckpt_out:
+                batch.astype("<f8").tofile(ckpt_out)
+        run_counts += batch_counts
+        nrun += nbatch
+        save_counts(ckpt_counts, run_counts, nrun,
+                    topdists if "sketch" in ARGDICT else None)
+        conf_int = perm_ci(topdists)
+    if null_file and len(topdists) > nstored:
+        with open(null_file, "ab") as null_out:
+            np.asarray(topdists[nstored:], dtype="<f8").tofile(null_out)
+        save_counts(count_file, counts + run_counts, ncounted + nrun)
+    # the combination is finished, so its checkpoint must not seed a later run
+    for filey in (ckpt_file, ckpt_counts):
+        if os.path.isfile(filey):
+            os.remove(filey)
+    return(perm_summary(outstring, key, topdists,
+                        (counts + run_counts, ncounted + nrun), conf_int))
+
+def combine_cutoffs(combocrit, stored):
+    """Takes the highest cutoffs among combinations and writes them out"""
+    if not combocrit:
+        error("NO PERMUTATIONS AVAILABLE TO COMPUTE A CUTOFF. SET -perm")
+    final_vals = [max(combo[3][ix] for combo in combocrit)
+                  for ix in range(len(ARGDICT["sig_levels"]))]
+    if "null_dir" in ARGDICT:
+        for combo in combocrit:
+            stored[combo[1]] = combo[0]
+        with open(ARGDICT["null_dir"]+"/null_index.txt", "w") as index_out:
+            for key in sorted(stored):
+                index_out.write("%s\t%s\n"%(key, stored[key]))
+    if len(ARGDICT["sig_levels"]) > 1:
+        with open(ARGDICT["outdir2"]+"/permutation_cutoffs.txt", "w") as cut_out:
+            for combo in combocrit:
+                for sig, crit in zip(ARGDICT["sig_levels"], combo[3]):
+                    cut_out.write("%s\t%s\t%s\t%s\n"%(combo[0], sig, crit, combo[2]))
+            for sig, crit in zip(ARGDICT["sig_levels"], final_vals):
+                cut_out.write("all\t%s\t%s\t%s\n"%(sig, crit,
+                                                   sum(combo[2] for combo in combocrit)))
+                print("statistical cutoff at %s is %s"%(sig, crit))
+    # this is for plotting
+    print("statistical cutoff is %s"%(final_vals[0]))
+    return(final_vals[0])
+
+def write_pvalues(noperm_dict, combocrit):
+    """Writes per-window permutation p-values of the averaged selected-control difference"""
+    counts = sum(combo[4][0] for combo in combocrit)
+    ncounted = sum(combo[4][1] for combo in combocrit)
+    if not ncounted:
+        return
+    pvals = (counts + 1.0)/(ncounted + 1.0)
+    with open(ARGDICT["outdir2"]+"/selected_average_pvalues.txt", "w") as pval_out:
+        for possa, val, count, pval in zip(noperm_dict["average"]["pos"],
+                                           noperm_dict["average"]["val"], counts, pvals):
+            pval_out.write("%s\t%s\t%s\t%s\n"%(possa, val, count, pval))
+
+def shard_plan(dictlist):
+    """Writes the permutation plan and the difference matrix for sharded runs"""
+    shard_dir = ARGDICT["outdir2"]+"/perm_shards"
+    if not os.path.isdir(shard_dir):
+        os.makedirs(shard_dir)
+    seed = ARGDICT["seed"] if "seed" in ARGDICT else random.randrange(2**32)
+    pairs = sorted(set(grp for new_permute_dict in dictlist for grp in new_permute_dict))
+    sels = [pair.split(",")[0] for pair in pairs]
+    unsels = [pair.split(",")[1] for pair in pairs]
+    diffs = np.array([combino(pair[0], pair[1])["val"] for pair in zip(sels, unsels)])
+    np.savez(shard_dir+"/diffs.npz", names=np.array(pairs),
+             pos=np.asarray(ARGDICT["master_dict"][sels[0]]["pos"]), diffs=diffs)
+    with open(shard_dir+"/plan.txt", "w") as plan_out:
+        for setting in ["perm", "shards", "window", "slide", "min_allele", "sketch"]:
+            if setting in ARGDICT:
+                plan_out.write("%s\t%s\n"%(setting, ARGDICT[setting]))
+        plan_out.write("seed\t%s\n"%(seed))
+        for new_permute_dict in dictlist:
+            plan_out.write("combination\t%s\n"%(";".join(sorted(new_permute_dict))))
+    print("PERMUTATION PLAN WRITTEN TO %s. RUN EACH SHARD WITH "
+          "-o %s -shard i (i = 1 to %s), THEN -o %s -merge"%(
+              shard_dir, ARGDICT["outdir"], ARGDICT["shards"], ARGDICT["outdir"]))
+
+def load_plan():
+    """Reads the permutation plan and rebuilds the combinations to permute"""
+    shard_dir = ARGDICT["outdir2"]+"/perm_shards"
+    if not os.path.isfile(shard_dir+"/plan.txt"):
+        error("NO PERMUTATION PLAN FOUND IN %s. RUN THE ANALYSIS WITH -shards FIRST"%(
+            shard_dir))
+    combos = []
+    with open(shard_dir+"/plan.txt") as openplan:
+        for line in openplan:
+            line = line.rstrip().split("\t")
+            if line[0] == "combination":
+                combos.append(line[1].split(";"))
+            elif line[0] in ("min_allele", "sketch"):
+                ARGDICT[line[0]] = float(line[1])
+            else:
+                ARGDICT[line[0]] = int(line[1])
+    matrix = np.load(shard_dir+"/diffs.npz")
+    pos = list(matrix["pos"])
+    rows = dict((str(name), list(row)) for name, row in zip(matrix["names"], matrix["diffs"]))
+    dictlist = []
+    for combo in combos:
+        new_permute_dict = {}
+        for pair in combo:
+            new_permute_dict[pair] = {"pos":pos, "val":rows[pair]}
+        dictlist.append(new_permute_dict)
+    # the first combination is the observed pairing
+    observed = 0.0
+    for pair in dictlist[0]:
+        observed = observed + np.asarray(dictlist[0][pair]["val"])
+    ARGDICT["observed"] = observed/float(len(dictlist[0]))
+    return(dictlist)
+
+def shard_process(ix_dict):
+    """Runs the permutations of one shard for one combination"""
+    ix_combo, new_permute_dict = ix_dict
+    nperm = ARGDICT["perm"]//ARGDICT["shards"]
+    if ARGDICT["shard"] <= ARGDICT["perm"] % ARGDICT["shards"]:
+        nperm += 1
+    # every combination and shard gets its own reproducible stream
+    rng = random.Random("%s-%s-%s"%(ARGDICT["seed"], ix_combo, ARGDICT["shard"]))
+    topdists, counts = permute_batch(new_permute_dict, nperm, rng)
+    if "sketch" in ARGDICT:
+        sketch = QuantileSketch(ARGDICT["sketch"])
+        sketch.extend(topdists)
+        topdists = sketch.counts
+    return(topdists, counts)
+
+def run_shard():
+    """Computes one shard of a sharded permutation run"""
+    dictlist = load_plan()
+    if not 1 <= ARGDICT["shard"] <= ARGDICT["shards"]:
+        error("SHARD MUST BE BETWEEN 1 AND %s"%(ARGDICT["shards"]))
+    print("RUNNING PERMUTATION SHARD %s OF %s"%(ARGDICT["shard"], ARGDICT["shards"]))
+    counters, progress = perm_progress("shard", dictlist,
+                                       -(-ARGDICT["perm"]//ARGDICT["shards"]))
+    pool = worker_pool(ARGDICT["n_threads"], counters)
+    results = pool.map(shard_process, list(enumerate(dictlist)))
+    pool.close()
+    pool.join()
+    progress.finish()
+    shard_file = ARGDICT["outdir2"]+"/perm_shards/shard_%s_of_%s.npz"%(
+        ARGDICT["shard"], ARGDICT["shards"])
+    # with -sketch, each shard holds sketches instead of the permutation maxima
+    np.savez(shard_file, topdists=np.array([i[0] for i in results]),
+             counts=np.array([i[1] for i in results]))
+    print("Saving shard to %s"%(shard_file))
+
+def merge_shards():
+    """Combines the shards into the final cutoff and permutations.txt"""
+    dictlist = load_plan()
+    print("MERGING %s PERMUTATION SHARDS"%(ARGDICT["shards"]))
+    shards = []
+    for shard in range(1, ARGDICT["shards"]+1):
+        shard_file = ARGDICT["outdir2"]+"/perm_shards/shard_%s_of_%s.npz"%(
+            shard, ARGDICT["shards"])
+        if not os.path.isfile(shard_file):
+            error("MISSING SHARD %s OF %s. EXITING PROGRAM."%(shard, ARGDICT["shards"]))
+        shards.append(np.load(shard_file))
+    perm_out = open(ARGDICT["outdir2"]+"/permutations.txt", "w")
     perm_out.close()
-    return(critical_val)
+    if "null_dir" in ARGDICT and not os.path.isdir(ARGDICT["null_dir"]):
+        os.makedirs(ARGDICT["null_dir"])
+    stored = stored_nulls()
+    combocrit = []
+    for ix_combo, new_permute_dict in enumerate(dictlist):
+        key, null_file, topdists, count_file, counts, ncounted = load_null(new_permute_dict)
+        counts = counts + sum(shard["counts"][ix_combo] for shard in shards)
+        if "sketch" in ARGDICT:
+            # worker sketches are merged without ever holding the maxima
+            topdists = QuantileSketch(ARGDICT["sketch"])
+            for shard in shards:
+                topdists.merge(QuantileSketch(ARGDICT["sketch"], shard["topdists"][ix_combo]))
+            ncounted += len(topdists)
+        else:
+            new_topdists = np.concatenate([shard["topdists"][ix_combo] for shard in shards])
+            ncounted += len(new_topdists)
+            if null_file:
+                with open(null_file, "ab") as null_out:
+                    new_topdists.tofile(null_out)
+                save_counts(count_file, counts, ncounted)
+            topdists = topdists + list(new_topdists)
+        combocrit.append(perm_summary(";".join(sorted(new_permute_dict)), key,
+                                      topdists, (counts, ncounted)))
+    ARGDICT["stat_cutoff"] = combine_cutoffs(combocrit, stored)
+    # the first combination is the observed pairing
+    comb_dict = dictlist[0]
+    noperm_dict = unpermute(comb_dict)
+    write_pvalues(noperm_dict, combocrit)
+    if "peaks" in ARGDICT:
+        write_peaks(noperm_dict, comb_dict)
+    plotter(noperm_dict)
+    plotter(comb_dict)
+    render_plots()
+    if "tiles" in ARGDICT:
+        write_tiles(dict(noperm_dict, **comb_dict))
 
 def unpermute(indict):
     """Average values among replicates"""
@@ -1276,11 +2680,12 @@ def unpermute(indict):
     noperm_dict["average"]["val"] = unpermuted_values
     noperm_dict["average"]["pos"] = unpermuted_pos
     bsa_out = open(ARGDICT["outdir2"]+"/selected_average.txt", "w")
-    positions = noperm_dict["average"]["pos"]
-    for possa in positions:
-        where = positions.index(possa)
-        bsa_out.write("%s\t%s\n"%
-                      (possa, noperm_dict["average"]["val"][where]))
+    for possa, val in zip(noperm_dict["average"]["pos"], noperm_dict["average"]["val"]):
+        bsa_out.write("%s\t%s\n"%(possa, val))
+    bsa_out.close()
+    # the same windows in binary, which -plot reads much faster
+    np.save(ARGDICT["outdir2"]+"/selected_average.npy",
+            np.array([noperm_dict["average"]["pos"], noperm_dict["average"]["val"]], dtype=float))
     return(noperm_dict)
 
 def combino(sel, unsel):
@@ -1305,91 +2710,498 @@ def permute_setup():
     noperm_dict = unpermute(comb_dict)
     print("unpermuted min is %s"%(min(noperm_dict["average"]["val"])))
     print("unpermuted max is %s"%(max(noperm_dict["average"]["val"])))
-    if ARGDICT["perm"] > 0:
+    if ARGDICT["perm"] > 0 or "null_dir" in ARGDICT:
+        # permuted windows are compared against the observed average
+        ARGDICT["observed"] = np.asarray(noperm_dict["average"]["val"])
+        if "null_dir" in ARGDICT and not os.path.isdir(ARGDICT["null_dir"]):
+            os.makedirs(ARGDICT["null_dir"])
+        stored = stored_nulls()
         if "unpaired" in ARGDICT:
             print("COLLECTING DATA TO PERMUTE")
             new_comb_dict = {}
             unsels = list(permutations(ARGDICT["control_offspring"]))
             unsels = unsels[1:]
-            random.shuffle(unsels)
+            if "seed" in ARGDICT:
+                random.Random(ARGDICT["seed"]).shuffle(unsels)
+            else:
+                random.shuffle(unsels)
+            if stored:
+                # combinations with stored null distributions are extended first
+                stored_names = set(stored.values())
+                unsels.sort(key=lambda unsel: ";".join(sorted(
+                    "%s,%s"%(strains[0], strains[1]) for strains in
+                    zip(ARGDICT["selected_offspring"], unsel))) not in stored_names)
             for unsel in unsels[:ARGDICT["combinations"]-1]:
                 for strains in zip(ARGDICT["selected_offspring"], unsel):
                     new_comb_dict["%s,%s"%(strains[0],
                                            strains[1])] = combino(strains[0], strains[1])
                 dictlist.append(new_comb_dict)
                 new_comb_dict = {}
+        if "shards" in ARGDICT:
+            shard_plan(dictlist)
+            return(noperm_dict, comb_dict, None)
         print("RUNNING PERMUTATIONS")
-        pool = multiprocessing.Pool(processes=ARGDICT["n_threads"])
-        combocrit = pool.map(permute_process, dictlist)
-        final_val = max(combocrit)
-        # this is for plotting
-        print("statistical cutoff is %s"%(final_val))
+        if "sketch" in ARGDICT:
+            print("cutoffs are kept in a quantile sketch and are within +/- %s "
+                  "of the exact values"%(ARGDICT["sketch"]/2.0))
+        if not os.path.isdir(ARGDICT["outdir1"]+"/checkpoints"):
+            os.makedirs(ARGDICT["outdir1"]+"/checkpoints")
+        counters, progress = perm_progress(
+            "permutations", dictlist, ARGDICT["perm"],
+            None if "approx" in ARGDICT else [resumed_perms(i) for i in dictlist])
+        pool = worker_pool(ARGDICT["n_threads"], counters)
+        worker = permute_approx if "approx" in ARGDICT else permute_process
+        combocrit = [i for i in pool.map(worker, dictlist) if i]
+        pool.close()
+        pool.join()
+        progress.finish()
+        count_units("permutations", sum(combo[2] for combo in combocrit))
+        final_val = combine_cutoffs(combocrit, stored)
+        write_pvalues(noperm_dict, combocrit)
     else:
         final_val = None
     return(noperm_dict, comb_dict, final_val)
 
-################################################################################################
-
-if ("selected_offspring" in ARGDICT
-        and "control_offspring" in ARGDICT):
-
-    if ("control_parent" in ARGDICT
-            and "selected_parent" in ARGDICT):
-
-        ALL_GROUPS = [ARGDICT["selected_offspring"], ARGDICT["control_offspring"],
-                      ARGDICT["control_parent"], ARGDICT["selected_parent"]]
-        LENGTHS = set([len(ARGDICT["selected_offspring"]), len(ARGDICT["control_offspring"]),
-                       len(ARGDICT["control_parent"]), len(ARGDICT["selected_parent"])])
-
-    elif "major_parent" in ARGDICT:
-        ALL_GROUPS = [ARGDICT["selected_offspring"], ARGDICT["control_offspring"],
-                      ARGDICT["major_parent"]]
-        LENGTHS = set([len(ARGDICT["selected_offspring"]), len(ARGDICT["control_offspring"]),
-                       len(ARGDICT["major_parent"])])
-    else:
-        ALL_GROUPS = [ARGDICT["selected_offspring"], ARGDICT["control_offspring"]]
-        LENGTHS = set([len(ARGDICT["selected_offspring"]), len(ARGDICT["control_offspring"])])
-        if ARGDICT["perm"]:
-            error("CANNOT RUN PERMUTATIONS IF PARENTAL DATA UNAVAILABLE")
-            sys.exit()
-
-    if len(LENGTHS) != 1:
-        if len(LENGTHS) == 2 and 1 in LENGTHS:
-            VALUE = int(list(LENGTHS - set([1]))[0])
-            for group in ALL_GROUPS:
-                if len(group) == 1:
-                    for _ngroup in range(VALUE-1):
-                        group.append(group[0])
+def window_contigs(positions):
+    """Index of the contig of each window, from its genome-wide midpoint"""
+    # the last midpoints of a contig can lie past its end, but never the window starts
+    return(genome_index().contig_of(np.asarray(positions) - ARGDICT["window"]/2.0))
+
+def peak_runs(positions, values, cutoff, maxgap=0):
+    """Finds runs of windows beyond the cutoff, merging runs less than maxgap apart"""
+    genome = genome_index()
+    positions = np.asarray(positions)
+    chrom_ix = window_contigs(positions)
+    above = np.flatnonzero(np.abs(values) >= cutoff)
+    if not len(above):
+        return([])
+    # a run ends at a chromosome boundary or at a gap wider than maxgap
+    split = ((np.diff(chrom_ix[above]) != 0)
+             | ((np.diff(above) > 1) & (np.diff(positions[above]) - ARGDICT["slide"] > maxgap)))
+    starts = above[np.concatenate(([True], split))]
+    ends = above[np.concatenate((split, [True]))]
+    runs = []
+    for beg, end in zip(starts, ends):
+        runs.append((genome.names[chrom_ix[beg]], genome.offsets[chrom_ix[beg]], beg, end))
+    return(runs)
+
+def call_peaks(spl, positions, values, cutoff):
+    """Turns runs of windows beyond the cutoff into peaks in chromosome coordinates"""
+    genome = genome_index()
+    positions = np.asarray(positions)
+    values = np.asarray(values)
+    peaks = []
+    for chrom, offset, beg, end in peak_runs(positions, values, cutoff, ARGDICT["peak_gap"]):
+        top = beg + np.abs(values[beg:end+1]).argmax()
+        # the peak spans every SNP of its windows
+        start = max(0, int(positions[beg] - offset - ARGDICT["window"]/2.0))
+        stop = min(genome.length(chrom), int(positions[end] - offset + ARGDICT["window"]/2.0))
+        peaks.append((chrom, start, stop, spl, values[top],
+                      min(genome.length(chrom), int(positions[top] - offset))))
+    return(peaks)
+
+def write_peaks(noperm_dict, comb_dict):
+    """Calls peaks on the averaged and per-pair series and writes them as a BED-like table"""
+    cutoff = ARGDICT["peak_cutoff"] if "peak_cutoff" in ARGDICT else ARGDICT.get("stat_cutoff")
+    if not cutoff:
+        print("NO CUTOFF TO CALL PEAKS WITH. RUN PERMUTATIONS OR SET -peakcut")
+        return
+    print("CALLING PEAKS ABOVE %s"%(cutoff))
+    peaks = call_peaks("average", noperm_dict["average"]["pos"],
+                       noperm_dict["average"]["val"], cutoff)
+    for spl in sorted(comb_dict):
+        peaks = peaks + call_peaks(spl, comb_dict[spl]["pos"], comb_dict[spl]["val"], cutoff)
+    peak_file = ARGDICT["outdir2"]+"/peaks.bed"
+    with open(peak_file, "w") as peak_out:
+        for peak in peaks:
+            peak_out.write("%s\t%s\t%s\t%s\t%s\t%s\n"%peak)
+    print("%s peaks written to %s"%(len(peaks), peak_file))
+    if "autozoom" in ARGDICT and peaks:
+        # zoom once on each stretch covered by overlapping peaks
+        regions = []
+        for chrom, start, stop in sorted([peak[:3] for peak in peaks]):
+            if regions and regions[-1][0] == chrom and start <= regions[-1][2]:
+                regions[-1][2] = max(regions[-1][2], stop)
+            else:
+                regions.append([chrom, start, stop])
+        region_file = ARGDICT["outdir2"]+"/peak_regions.txt"
+        with open(region_file, "w") as region_out:
+            for region in regions:
+                region_out.write("%s\t%s\t%s\n"%tuple(region))
+        ARGDICT["zoom_file"] = region_file
+
+def boot_process(task):
+    """Bootstraps the position and height of one peak"""
+    mode, data, mids, sign, nboot, seed, window, min_allele = task
+    rng = np.random.RandomState(seed)
+    peaks = np.full(nboot, np.nan)
+    heights = np.full(nboot, np.nan)
+    for ix in range(nboot):
+        if mode == "snps":
+            # resample SNPs and redo the windows of every sample
+            positions, values, sel_rows, con_rows, begs = data
+            pick = np.sort(rng.randint(0, len(positions), len(positions)))
+            means = np.array([fast_windows(positions[pick], row[pick], begs,
+                                           window, min_allele)[0] for row in values])
+            average = sign*np.mean(means[sel_rows] - means[con_rows], axis=0)
         else:
-            error("DIFFERENT NUMBERS OF INDIVIDUALS IN GROUPS. EXITING PROGRAM.")
-
-    # finds average genome-wide read coverage for each strain/population in VCF file
-    coverage()
-
-    # goes over VCF and outputs allele frequencies to be used in sliding window analysis
-    VCFTUPLE = get_vcftuple()
-
-    # this outouts sliding windows
-    FINAL_DICT = slider(VCFTUPLE)
+            # resample selected-control pairs
+            average = sign*np.mean(data[rng.randint(0, len(data), len(data))], axis=0)
+        if not np.all(np.isnan(average)):
+            best = np.nanargmax(average)
+            peaks[ix] = mids[best]
+            heights[ix] = average[best]
+    return(peaks, heights)
+
+def region_snps(vcf_tuple, chrom, beg, end, samples):
+    """Collects SNP values of each sample between two positions of a chromosome"""
+    positions = []
+    rows = dict((spl, []) for spl in samples)
+    for binny in sorted(vcf_tuple[0][chrom]):
+        if binny + ARGDICT["binsize"] < beg or binny > end:
+            continue
+        for snppy in sorted(vcf_tuple[0][chrom][binny]):
+            snp_spls = vcf_tuple[0][chrom][binny][snppy]
+            if beg <= snppy <= end and snp_spls:
+                positions.append(snppy)
+                for spl in samples:
+                    rows[spl].append(snp_spls.get(spl, np.nan))
+    return(np.array(positions), np.array([rows[spl] for spl in samples], dtype=float))
+
+def peak_bootstrap(vcf_tuple, comb_dict, noperm_dict):
+    """Bootstrap confidence intervals for the position of each significant peak"""
+    print("BOOTSTRAPPING PEAK POSITIONS")
+    pairs = list(zip(ARGDICT["selected_offspring"], ARGDICT["control_offspring"]))
+    samples = sorted(set(ARGDICT["selected_offspring"]) | set(ARGDICT["control_offspring"]))
+    positions = np.asarray(noperm_dict["average"]["pos"])
+    average = np.asarray(noperm_dict["average"]["val"])
+    genome = genome_index()
+    chrom_ix = window_contigs(positions)
+    tasks = []
+    peaks = []
+    for chrom, offset, beg, end in peak_runs(positions, average, ARGDICT["stat_cutoff"],
+                                             ARGDICT["peak_gap"]):
+        sign = 1 if average[beg:end+1].max() >= -average[beg:end+1].min() else -1
+        # the windows around the run, half a window to each side
+        lo_mid = positions[beg] - offset - ARGDICT["window"]/2.0
+        hi_mid = positions[end] - offset + ARGDICT["window"]/2.0
+        begs = np.arange(0, hi_mid, ARGDICT["slide"])
+        begs = begs[begs + ARGDICT["window"]/2.0 >= lo_mid]
+        mids = begs + ARGDICT["window"]/2.0
+        if ARGDICT["boot_by"] == "snps":
+            snp_pos, values = region_snps(vcf_tuple, chrom, begs[0],
+                                          begs[-1] + ARGDICT["window"], samples)
+            data = (snp_pos, values, [samples.index(pair[0]) for pair in pairs],
+                    [samples.index(pair[1]) for pair in pairs], begs)
+        else:
+            where = ((chrom_ix == genome.contig_ix[chrom])
+                     & (positions - offset >= mids[0]) & (positions - offset <= mids[-1]))
+            mids = positions[where] - offset
+            data = np.array([np.asarray(comb_dict["%s,%s"%pair]["val"])[where]
+                             for pair in pairs])
+        observed = sign*average[beg:end+1]
+        peaks.append((chrom, positions[beg] - offset, positions[end] - offset,
+                      positions[beg:end+1][observed.argmax()] - offset,
+                      average[beg:end+1][observed.argmax()], observed, beg))
+        # the resamples of every peak are spread over the pool in chunks
+        nchunks = min(ARGDICT["n_threads"], ARGDICT["boot"])
+        for chunk in range(nchunks):
+            nboot = ARGDICT["boot"]//nchunks + (1 if chunk < ARGDICT["boot"] % nchunks else 0)
+            # each chunk gets its own stream, reproducible under -seed like the shards
+            if "seed" in ARGDICT:
+                seed = random.Random("%s-boot-%s-%s"%(
+                    ARGDICT["seed"], len(peaks)-1, chunk)).randrange(2**31)
+            else:
+                seed = random.randrange(2**31)
+            tasks.append((len(peaks)-1, (ARGDICT["boot_by"], data, mids, sign, nboot,
+                                         seed, ARGDICT["window"], ARGDICT["min_allele"])))
+    if not peaks:
+        print("NO PEAKS ABOVE THE CUTOFF TO BOOTSTRAP")
+        return
+    pool = worker_pool(ARGDICT["n_threads"])
+    results = pool.map(boot_process, [task[1] for task in tasks])
+    pool.close()
+    pool.join()
+    boot_out = open(ARGDICT["outdir2"]+"/peak_intervals.txt", "w")
+    boot_out.write("#chrom\trun_start\trun_end\tpeak_pos\tpeak_val\t"
+                   "ci_low\tci_high\tsupport_start\tsupport_end\tn_boot\n")
+    for ix_peak, peak in enumerate(peaks):
+        boot_peaks = np.concatenate([res[0] for task, res in zip(tasks, results)
+                                     if task[0] == ix_peak])
+        boot_heights = np.concatenate([res[1] for task, res in zip(tasks, results)
+                                       if task[0] == ix_peak])
+        boot_heights = boot_heights[~np.isnan(boot_peaks)]
+        boot_peaks = boot_peaks[~np.isnan(boot_peaks)]
+        ci_low, ci_high = np.percentile(boot_peaks, [2.5, 97.5])
+        # support interval: windows around the peak within 1.96 bootstrap SDs of its height
+        observed = peak[5]
+        within = observed >= observed.max() - 1.96*np.std(boot_heights)
+        top = observed.argmax()
+        left = top
+        while left > 0 and within[left-1]:
+            left -= 1
+        right = top
+        while right < len(observed)-1 and within[right+1]:
+            right += 1
+        run_pos = positions[peak[6]:peak[6]+len(observed)] - (positions[peak[6]] - peak[1])
+        boot_out.write("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n"%(
+            peak[0], peak[1], peak[2], peak[3], peak[4], ci_low, ci_high,
+            run_pos[left], run_pos[right], len(boot_peaks)))
+        print("peak on %s at %s, 95%% CI %s-%s"%(peak[0], peak[3], ci_low, ci_high))
+    boot_out.close()
+
+class BSAExperiment(object):
+    """A BSA analysis that keeps its parsed data in memory between steps
+
+    Takes the command line arguments as a list, or settings named after the
+    long options, e.g. BSAExperiment(vcf="my.vcf", outdir="my_out",
+    selected_offspring="S1,S2", control_offspring="C1,C2", window=200000).
+    After configure() changes settings, a step is redone only if its inputs
+    changed, and the VCF is read again only if the file itself changed.
+    """
+
+    def __init__(self, argv=None, **settings):
+        self.argv = list(argv) if argv is not None else []
+        self.settings = {}
+        self.argdict = {}
+        self.cache = {}
+        # records are kept so that changed filters do not read the VCF again
+        self.keep_records = True
+        self.configure(**settings)
+
+    def configure(self, **settings):
+        """Changes settings, keeping the results of steps they do not affect"""
+        self.settings.update(settings)
+        self.argdict = parse_args(self.argv + settings_argv(self.settings))
+        self.activate()
+
+    def activate(self):
+        """Points the pipeline functions at the settings of this experiment"""
+        global ARGDICT
+        ARGDICT = self.argdict
+
+    def keys(self):
+        """Hashes the inputs of each step, as -resume does"""
+        self.activate()
+        cov_key = stage_key(file_signature(ARGDICT["vcf"]) + ",".join(ARGDICT["all_pops"]),
+                            ["min_scaffold"])
+        parse_key = stage_key(cov_key + file_signature(ARGDICT.get("masking_file")),
+                              ["selected_parent", "control_parent", "major_parent",
+                               "haplodiploid", "selected_offspring", "control_offspring",
+                               "mac", "coverage_over", "coverage_under", "binsize",
+                               "qds", "mps", "sor", "mqrs", "rprs"])
+        window_key = stage_key(parse_key, ["window", "slide", "min_allele"])
+        perm_key = stage_key(window_key, ["perm", "sig_levels", "perm_tolerance", "perm_batch",
+                                          "approx", "approx_cal", "sketch", "unpaired",
+                                          "combinations", "null_dir", "shards", "seed"])
+        return({"coverage": cov_key, "parse": parse_key, "windows": window_key,
+                "permutations": perm_key})
+
+    def step(self, stage, key, outputs, func, *args):
+        """Runs a stage unless this experiment or an earlier run already has its result"""
+        self.activate()
+        if (stage in self.cache and self.cache[stage][0] == key
+                and all(os.path.isfile(output) for output in outputs)):
+            return(self.cache[stage][1])
+        result = checkpoint(stage, key, outputs, func, *args)
+        self.cache[stage] = (key, result)
+        return(result)
+
+    def records(self):
+        """The VCF records before any filtering, read once for each VCF and set of samples"""
+        key = self.keys()["coverage"]
+        if "records" not in self.cache or self.cache["records"][0] != key:
+            self.cache["records"] = (key, read_vcf(keep=True))
+        return(self.cache["records"][1])
+
+    def load(self):
+        """Gets coverage and the filtered allele frequencies from the VCF"""
+        keys = self.keys()
+        # finds average genome-wide read coverage for each strain/population in VCF file
+        self.step("coverage", keys["coverage"], [ARGDICT["outdir1"]+"/chrom_file.txt",
+                                                 ARGDICT["outdir1"]+"/coverageinfo.txt"],
+                  coverage)
+        # goes over VCF and outputs allele frequencies to be used in sliding window analysis
+        return(self.step("parse", keys["parse"], [],
+                         lambda: get_vcftuple(self.records() if self.keep_records
+                                              else None)))
+
+    def windows(self):
+        """Runs the sliding windows and fills in windows missing from some samples"""
+        vcf_tuple = self.load()
+        keys = self.keys()
+        final_dict = self.step("windows", keys["windows"], [], slider, vcf_tuple)
+        return(self.step("fill_in", keys["windows"], [], fill_in, final_dict))
+
+    def permute(self):
+        """Averages the replicates, finds the cutoff and calls peaks"""
+        new_final_dict = self.windows()
+        keys = self.keys()
+        ARGDICT["master_dict"] = new_final_dict
+        perm_results = self.step("permutations", keys["permutations"],
+                                 [ARGDICT["outdir2"]+"/permutations.txt"], permute_setup)
+        if perm_results[2]:
+            ARGDICT["stat_cutoff"] = perm_results[2]
+        if "boot" in ARGDICT:
+            if "stat_cutoff" in ARGDICT:
+                peak_bootstrap(self.load(), perm_results[1], perm_results[0])
+            else:
+                print("NO PERMUTATION CUTOFF, SKIPPING THE PEAK BOOTSTRAP")
+        if "peaks" in ARGDICT:
+            write_peaks(perm_results[0], perm_results[1])
+        ARGDICT["perm_results"] = perm_results
+        return(perm_results)
+
+    def plot(self):
+        """Plots the samples, their average and each selected-control pair"""
+        new_final_dict = self.windows()
+        # peaks are called first, so that -autozoom also zooms in on the samples
+        if "perm_results" in ARGDICT:
+            perm_results = ARGDICT["perm_results"]
+        else:
+            perm_results = self.permute()
+        plotter(new_final_dict)
+        plotter(perm_results[0])
+        plotter(perm_results[1])
+        render_plots()
+        if "tiles" in ARGDICT:
+            write_tiles(dict(perm_results[0], **perm_results[1]))
+
+    def run(self):
+        """Runs every step, as the command line does"""
+        self.plot()
+
+    def load_together(self, experiments):
+        """Reads and filters the VCF once for other experiments on it, e.g. sets of filters"""
+        keys = self.keys()
+        self.step("coverage", keys["coverage"], [ARGDICT["outdir1"]+"/chrom_file.txt",
+                                                 ARGDICT["outdir1"]+"/coverageinfo.txt"],
+                  coverage)
+        for experiment in experiments:
+            outdir1 = experiment.argdict["outdir1"]
+            if not os.path.isdir(outdir1):
+                os.makedirs(outdir1)
+            # the coverage of each experiment is the one of the shared VCF
+            for filey in ["chrom_file.txt", "coverageinfo.txt"]:
+                shutil.copyfile(self.argdict["outdir1"]+"/"+filey, outdir1+"/"+filey)
+        results = profiled("parse", get_vcftuples,
+                           self.records() if self.keep_records else None,
+                           [experiment.argdict for experiment in experiments])
+        for experiment, result in zip(experiments, results):
+            experiment.activate()
+            print("SETTINGS OF %s:"%(ARGDICT["outdir"]))
+            report_vcftuple(result)
+            keys = experiment.keys()
+            experiment.cache["coverage"] = (keys["coverage"], None)
+            experiment.cache["parse"] = (keys["parse"], result["vcf_tuple"])
+        self.activate()
+        return(results)
+
+    def qc_sets(self):
+        """An experiment for every combination of the filters given several values"""
+        sweep = self.argdict["qc_sweep"]
+        actions = dict((action.dest, action) for action in PARSER._actions)
+        qc_sets = []
+        for values in product(*[values for _setting, values in sweep]):
+            name = "_".join("%s%g"%(actions[setting].option_strings[0].lstrip("-"), value)
+                            for (setting, _values), value in zip(sweep, values))
+            settings = dict(zip([setting for setting, _values in sweep], values))
+            settings["outdir"] = self.argdict["outdir"]+"/qc_sets/"+name
+            qc_sets.append((name, BSAExperiment(self.argv + settings_argv(self.settings)
+                                                + settings_argv(settings))))
+        self.activate()
+        return(qc_sets)
+
+    def write_qc_sets(self, qc_sets, results):
+        """Lists the sets of filters of a sweep with the number of SNPs each kept"""
+        sweep = self.argdict["qc_sweep"]
+        with open(self.argdict["outdir"]+"/qc_sets/qc_sets.txt", "w") as sets_out:
+            sets_out.write("#set\t%s\tsnps_qc\tsnps_passed\n"%(
+                "\t".join(setting for setting, _values in sweep)))
+            for (name, experiment), result in zip(qc_sets, results):
+                sets_out.write("%s\t%s\t%s\t%s\n"%(
+                    name, "\t".join("%g"%(experiment.argdict[setting])
+                                     for setting, _values in sweep),
+                    result["qc"], result["passed"]))
+        print("THE SETS OF FILTERS ARE LISTED IN %s"%(
+            self.argdict["outdir"]+"/qc_sets/qc_sets.txt"))
+
+    def qc_sweep(self):
+        """Runs every combination of the filters given several values, e.g. -qds 2,5"""
+        qc_sets = self.qc_sets()
+        print("RUNNING %s SETS OF FILTERS"%(len(qc_sets)))
+        experiments = [experiment for _name, experiment in qc_sets]
+        self.write_qc_sets(qc_sets, self.load_together(experiments))
+        run_experiments(experiments)
+
+    def run_designs(self):
+        """Runs the designs of -designs, reading and filtering the VCF once for all of them"""
+        designs = []
+        for name, settings in read_designs(self.argdict["designs"]):
+            settings = dict(settings)
+            settings.setdefault("outdir", self.argdict["outdir"]+"/"+name)
+            design = BSAExperiment(self.argv + settings_argv(self.settings)
+                                   + settings_argv(settings))
+            if not ("selected_offspring" in design.argdict
+                    and "control_offspring" in design.argdict):
+                error("DESIGN %s NEEDS SELECTED AND CONTROL OFFSPRING"%(name))
+            if (design.argdict["vcf"] != self.argdict["vcf"]
+                    or design.argdict["min_scaffold"] != self.argdict["min_scaffold"]):
+                error("DESIGN %s MUST USE THE VCF AND -f OF THE COMMAND LINE"%(name))
+            # a design with several values of a filter runs each set of them
+            qc_sets = design.qc_sets() if "qc_sweep" in design.argdict else None
+            designs.append((name, design, qc_sets))
+        # the VCF is read with the samples of every design
+        self.argdict["all_pops"] = sorted(set().union(*[design.argdict["all_pops"]
+                                                        for _name, design, _sets in designs]))
+        experiments = []
+        for _name, design, qc_sets in designs:
+            experiments.extend([experiment for _set, experiment in qc_sets] if qc_sets
+                               else [design])
+        print("RUNNING %s DESIGNS"%(len(designs)))
+        results = self.load_together(experiments)
+        with open(self.argdict["outdir"]+"/designs.txt", "w") as designs_out:
+            designs_out.write("#design\toutdir\tsnps_qc\tsnps_passed\n")
+            beg = 0
+            for name, design, qc_sets in designs:
+                end = beg + (len(qc_sets) if qc_sets else 1)
+                for experiment, result in zip(experiments[beg:end], results[beg:end]):
+                    designs_out.write("%s\t%s\t%s\t%s\n"%(
+                        name, experiment.argdict["outdir"], result["qc"], result["passed"]))
+                if qc_sets:
+                    design.write_qc_sets(qc_sets, results[beg:end])
+                beg = end
+        print("THE DESIGNS ARE LISTED IN %s"%(self.argdict["outdir"]+"/designs.txt"))
+        run_experiments(experiments, self.argdict["design_processes"])
+        self.activate()
+
+def main(argv=None):
+    """Runs BSA with command line arguments"""
+    experiment = BSAExperiment(sys.argv[1:] if argv is None else argv)
+    # a single run reads the VCF once, so it is streamed
+    experiment.keep_records = False
+    if "shard" in ARGDICT:
+        run_shard()
+    elif "merge" in ARGDICT:
+        merge_shards()
+    elif "designs" in ARGDICT:
+        experiment.run_designs()
+    elif ("selected_offspring" in ARGDICT
+          and "control_offspring" in ARGDICT and "qc_sweep" in ARGDICT):
+        experiment.qc_sweep()
+    elif ("selected_offspring" in ARGDICT
+          and "control_offspring" in ARGDICT):
+        experiment.run()
+    elif "plot" in ARGDICT:
+        plotting_info = plot_dict()
+        plotter(plotting_info)
+        render_plots()
+        if "tiles" in ARGDICT:
+            write_tiles(plotting_info)
+    else:
+        error("PLEASE EITHER PROVIDE PARENTAL/OFFSPRING OR PLOTTING INFORMATION")
 
-    if not os.path.isdir("%s"%ARGDICT["outdir3"]):
-        subprocess.call("mkdir %s"%(ARGDICT["outdir3"]), shell=True)
+################################################################################################
 
-    NEW_FINAL_DICT = fill_in(FINAL_DICT)
-    plotter(NEW_FINAL_DICT)
-    ARGDICT["master_dict"] = NEW_FINAL_DICT
-    PERM_RESULTS = permute_setup()
-    AV_UNPERM_DICT = PERM_RESULTS[0]
-    UNPERM_DICT = PERM_RESULTS[1]
-    if PERM_RESULTS[2]:
-        ARGDICT["stat_cutoff"] = PERM_RESULTS[2]
-    plotter(AV_UNPERM_DICT)
-    plotter(UNPERM_DICT)
-elif "plot" in ARGDICT:
-    PLOTTING_INFO = plot_dict()
-    plotter(PLOTTING_INFO)
-
-else:
-    error("PLEASE EITHER PROVIDE PARENTAL/OFFSPRING OR PLOTTING INFORMATION")
-
-#############################################################################################
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+"""Writes a synthetic BSA VCF file of a given genome size, SNP density and design"""
+
+import argparse
+import sys
+
+import numpy as np
+
+MODES = ["parents", "hpd", "major", "noparents"]
+CHUNK = 100000 # SNPs generated together as arrays
+
+PARSER = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter)
+PARSER.add_argument("-o", "--out", required=True,
+                    help="VCF file to write")
+PARSER.add_argument("-g", "--genome", required=False, default=90e6,
+                    help="Genome size in bp, e.g. 90e6 for spider mite or 2.3e9 for maize")
+PARSER.add_argument("-c", "--contigs", required=False, default=3,
+                    help="Number of contigs of equal length")
+PARSER.add_argument("-d", "--density", required=False, default=1.0,
+                    help="SNPs per kb")
+PARSER.add_argument("-r", "--replicates", required=False, default=3,
+                    help="Number of selected-control replicate pairs")
+PARSER.add_argument("-mode", "--mode", required=False, default="parents", choices=MODES,
+                    help="Parents in the VCF: both (-psel/-pcon), both with a haplodiploid "
+                         "selected parent (-hpd), one known parent (-pmaj) or none")
+PARSER.add_argument("-depth", "--depth", required=False, default=30,
+                    help="Mean read depth of each sample")
+PARSER.add_argument("-seed", "--seed", required=False, default=1,
+                    help="Random seed")
+
+def design(mode, replicates):
+    """Sample names of the VCF and the matching RUN_BSA arguments"""
+    selected = ["S%s"%(rep) for rep in range(1, replicates+1)]
+    control = ["C%s"%(rep) for rep in range(1, replicates+1)]
+    args = ["-osel", ",".join(selected), "-ocon", ",".join(control)]
+    if mode == "parents":
+        parents = ["PS", "PC"]
+        args = ["-psel", "PS", "-pcon", "PC"] + args
+    elif mode == "hpd":
+        parents = ["PS", "PC"]
+        args = ["-psel", "PS", "-pcon", "PC", "-hpd", "PS"] + args
+    elif mode == "major":
+        parents = ["PS"]
+        args = ["-pmaj", "PS"] + args
+    else:
+        parents = []
+    return(parents + selected + control, args)
+
+def sample_fields(rng, freqs, depth):
+    """Genotype, allele depth and depth fields of a sample at many SNPs"""
+    depths = rng.poisson(depth, len(freqs)) + 1
+    refs = rng.binomial(depths, np.clip(freqs, 0, 1))
+    fields = []
+    for ref, total in zip(refs.tolist(), depths.tolist()):
+        if ref == total:
+            call = "0/0"
+        elif ref == 0:
+            call = "1/1"
+        else:
+            call = "0/1"
+        fields.append("%s:%s,%s:%s"%(call, ref, total-ref, total))
+    return(fields)
+
+def write_vcf(out, genome=90e6, contigs=3, density=1.0, replicates=3, mode="parents",
+              depth=30, seed=1):
+    """Writes the VCF and returns its sample names, RUN_BSA arguments and number of SNPs"""
+    rng = np.random.RandomState(seed)
+    samples, args = design(mode, replicates)
+    length = int(genome)//contigs
+    names = ["chr%s"%(ix) for ix in range(1, contigs+1)]
+    nsnps = 0
+    with open(out, "w") as vcf_out:
+        vcf_out.write("##fileformat=VCFv4.2\n")
+        for name in names:
+            vcf_out.write("##contig=<ID=%s,length=%s>\n"%(name, length))
+        vcf_out.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t%s\n"%(
+            "\t".join(samples)))
+        for name in names:
+            # SNPs are spread evenly, with a selected locus in the middle of the first contig
+            positions = np.unique(rng.randint(1, length, int(length*density/1000.0)))
+            for beg in range(0, len(positions), CHUNK):
+                pos = positions[beg:beg+CHUNK]
+                shift = np.zeros(len(pos))
+                if name == names[0]:
+                    shift = 0.4*np.clip(1 - np.abs(pos - length/2.0)/(length/5.0), 0, 1)
+                fields = []
+                for spl in samples:
+                    if spl[0] == "P":
+                        # the parents carry opposite alleles
+                        call = "0/0" if spl == "PS" else "1/1"
+                        fields.append(["%s:%s,0:%s"%(call, depth, depth) if spl == "PS"
+                                       else "%s:0,%s:%s"%(call, depth, depth)]*len(pos))
+                    else:
+                        freqs = 0.5 + rng.normal(0, 0.03, len(pos))
+                        if spl[0] == "S":
+                            freqs = freqs + shift
+                        fields.append(sample_fields(rng, freqs, depth))
+                # quality annotations cover the defaults of every filter, so some SNPs fail
+                quals = np.column_stack([rng.uniform(low, high, len(pos)) for low, high in
+                                         [(1, 30), (45, 60), (0, 4), (-3, 3), (-3, 3)]])
+                for ix, possa in enumerate(pos.tolist()):
+                    vcf_out.write("%s\t%s\t.\tA\tG\t100\tPASS\tQD=%.1f;MQ=%.1f;SOR=%.2f;"
+                                  "MQRankSum=%.2f;ReadPosRankSum=%.2f\tGT:AD:DP\t%s\n"%(
+                                      (name, possa) + tuple(quals[ix])
+                                      + ("\t".join([field[ix] for field in fields]),)))
+                nsnps += len(pos)
+    return(samples, args, nsnps)
+
+def main():
+    """Writes a VCF from the command line"""
+    argies = PARSER.parse_args()
+    samples, args, nsnps = write_vcf(argies.out, float(argies.genome), int(argies.contigs),
+                                     float(argies.density), int(argies.replicates),
+                                     argies.mode, int(argies.depth), int(argies.seed))
+    sys.stdout.write("%s SNPs of %s samples written to %s\n"%(nsnps, len(samples), argies.out))
+    sys.stdout.write("RUN_BSA arguments: -v %s %s\n"%(argies.out, " ".join(args)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+"""Times each stage of RUN_BSA on synthetic VCF files and writes the timings as JSON"""
+
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+import bsa
+from make_vcf import MODES, write_vcf
+
+# genome size, window and slide of the genomes in the README
+SCALES = {"mite": (90e6, 75000, 5000), "maize": (2.3e9, 5000000, 500000)}
+STAGES = ["coverage", "get_vcftuple", "slider", "fill_in", "permute_setup", "plotter"]
+
+PARSER = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter)
+PARSER.add_argument("-o", "--out", required=False, default="benchmark.json",
+                    help="JSON file with the timings")
+PARSER.add_argument("-work", "--workdir", required=False, default="bsa_benchmarks",
+                    help="Directory for the synthetic VCF files and the BSA output")
+PARSER.add_argument("-scale", "--scale", required=False, default="mite",
+                    choices=sorted(SCALES),
+                    help="Genome size, window and slide of a spider mite or a maize genome")
+PARSER.add_argument("-g", "--genome", required=False, default=None,
+                    help="Genome size in bp, instead of the one of -scale")
+PARSER.add_argument("-c", "--contigs", required=False, default=3,
+                    help="Number of contigs")
+PARSER.add_argument("-d", "--density", required=False, default="1",
+                    help="SNPs per kb, several separated by commas")
+PARSER.add_argument("-r", "--replicates", required=False, default="3",
+                    help="Replicate pairs, several separated by commas")
+PARSER.add_argument("-modes", "--modes", required=False, default=",".join(MODES),
+                    help="Designs to time, separated by commas: %s"%(", ".join(MODES)))
+PARSER.add_argument("-perm", "--perm", required=False, default=100,
+                    help="Number of permutations (not run without parents)")
+PARSER.add_argument("-n", "--n_threads", required=False, default=1,
+                    help="Processing cores of the stages that use several")
+PARSER.add_argument("-repeat", "--repeat", required=False, default=1,
+                    help="Times each stage is run")
+PARSER.add_argument("-compare", "--compare", required=False, default=None, nargs=2,
+                    help="Compare two JSON files instead of running, e.g. old.json new.json")
+
+def script_version():
+    """Checksum of RUN_BSA and the git commit it comes from, if any"""
+    with open(bsa.__file__, "rb") as openscript:
+        sha1 = hashlib.sha1(openscript.read()).hexdigest()
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(
+            bsa.__file__), stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return({"script": bsa.__file__, "sha1": sha1, "commit": commit})
+
+def timed(func, *args):
+    """Runs a stage and returns its result, wall time and CPU time of this and child processes"""
+    wall = time.time()
+    cpu = time.process_time()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    result = func(*args)
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = (time.process_time() - cpu + after.ru_utime - children.ru_utime
+           + after.ru_stime - children.ru_stime)
+    return(result, time.time() - wall, cpu)
+
+def plot_all(perm_results, new_final_dict):
+    """Queues and draws the three plots of a run"""
+    bsa.plotter(new_final_dict)
+    bsa.plotter(perm_results[0])
+    bsa.plotter(perm_results[1])
+    bsa.render_plots()
+
+def run_stages(argv):
+    """Times every stage of one BSA run, in the order the pipeline runs them"""
+    experiment = bsa.BSAExperiment(argv)
+    experiment.activate()
+    times = {}
+    def record(stage, func, *args):
+        result, wall, cpu = timed(func, *args)
+        times[stage] = {"wall": wall, "cpu": cpu}
+        return(result)
+    record("coverage", bsa.coverage)
+    vcf_tuple = record("get_vcftuple", bsa.get_vcftuple)
+    final_dict = record("slider", bsa.slider, vcf_tuple)
+    new_final_dict = record("fill_in", bsa.fill_in, final_dict)
+    bsa.ARGDICT["master_dict"] = new_final_dict
+    perm_results = record("permute_setup", bsa.permute_setup)
+    record("plotter", plot_all, perm_results, new_final_dict)
+    counts = {"windows": len(new_final_dict[sorted(new_final_dict)[0]]["pos"])}
+    return(times, counts)
+
+def benchmark(argies):
+    """Generates the VCF of every design and times its stages"""
+    genome, window, slide = SCALES[argies.scale]
+    if argies.genome:
+        genome = float(argies.genome)
+    if not os.path.isdir(argies.workdir):
+        os.makedirs(argies.workdir)
+    runs = []
+    for mode in argies.modes.split(","):
+        for density in [float(i) for i in argies.density.split(",")]:
+            for replicates in [int(i) for i in argies.replicates.split(",")]:
+                name = "%s_%s_%s_%s"%(mode, int(genome), density, replicates)
+                vcf = os.path.join(argies.workdir, name + ".vcf")
+                print("GENERATING %s"%(vcf))
+                _samples, args, nsnps = write_vcf(vcf, genome, int(argies.contigs), density,
+                                                  replicates, mode)
+                perm = 0 if mode == "noparents" else int(argies.perm)
+                argv = args + ["-v", vcf, "-o", os.path.join(argies.workdir, name),
+                               "-w", str(window), "-s", str(slide), "-f", "0",
+                               "-perm", str(perm), "-n", str(argies.n_threads)]
+                run = {"mode": mode, "genome": genome, "density": density,
+                       "replicates": replicates, "snps": nsnps, "argv": argv,
+                       "stages": dict((stage, {"wall": [], "cpu": []}) for stage in STAGES)}
+                for repeat in range(int(argies.repeat)):
+                    print("TIMING %s, RUN %s"%(name, repeat+1))
+                    if not os.path.isdir(os.path.join(argies.workdir, name)):
+                        os.makedirs(os.path.join(argies.workdir, name))
+                    # the status lines of the stages go to a log next to their output
+                    with open(os.path.join(argies.workdir, name + ".log"), "w") as log:
+                        with contextlib.redirect_stdout(log):
+                            times, counts = run_stages(argv)
+                    for stage in STAGES:
+                        run["stages"][stage]["wall"].append(times[stage]["wall"])
+                        run["stages"][stage]["cpu"].append(times[stage]["cpu"])
+                    run.update(counts)
+                for stage in STAGES:
+                    print("%s\t%s\t%.3f s"%(name, stage, min(run["stages"][stage]["wall"])))
+                runs.append(run)
+    return(runs)
+
+def compare(old_file, new_file):
+    """Prints the ratio of the best wall times of each stage between two JSON files"""
+    with open(old_file) as openold:
+        old = json.load(openold)
+    with open(new_file) as opennew:
+        new = json.load(opennew)
+    old_runs = dict(((run["mode"], run["genome"], run["density"], run["replicates"]), run)
+                    for run in old["runs"])
+    print("mode\tgenome\tdensity\treplicates\tstage\told_s\tnew_s\tnew/old")
+    for run in new["runs"]:
+        key = (run["mode"], run["genome"], run["density"], run["replicates"])
+        if key not in old_runs:
+            continue
+        for stage in STAGES:
+            old_wall = min(old_runs[key]["stages"][stage]["wall"])
+            new_wall = min(run["stages"][stage]["wall"])
+            print("%s\t%s\t%s\t%s\t%s\t%.3f\t%.3f\t%.2f"%(
+                key + (stage, old_wall, new_wall, new_wall/old_wall if old_wall else np.nan)))
+
+def main():
+    """Runs the benchmarks, or compares two of their JSON files"""
+    argies = PARSER.parse_args()
+    if argies.compare:
+        compare(argies.compare[0], argies.compare[1])
+        return
+    runs = benchmark(argies)
+    results = {"bsa": script_version(), "python": platform.python_version(),
+               "numpy": np.__version__, "machine": platform.platform(),
+               "cpus": os.cpu_count(), "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+               "runs": runs}
+    with open(argies.out, "w") as json_out:
+        json.dump(results, json_out, indent=1)
+    print("TIMINGS WRITTEN TO %s"%(argies.out))
+
+if __name__ == "__main__":
+    main()
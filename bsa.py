@@ -0,0 +1,24 @@
+"""Importable name for RUN_BSA1.02.py
+
+For example, in a notebook:
+
+    from bsa import BSAExperiment
+    experiment = BSAExperiment(vcf="my.vcf", outdir="my_out", selected_parent="PS",
+                               control_parent="PC", selected_offspring="S1,S2",
+                               control_offspring="C1,C2")
+    experiment.windows()
+    experiment.configure(window=100000)
+    experiment.plot()
+"""
+
+import importlib.util
+import os
+import sys
+
+_SPEC = importlib.util.spec_from_file_location(
+    __name__, os.path.join(os.path.dirname(os.path.abspath(__file__)), "RUN_BSA1.02.py"))
+_BSA = importlib.util.module_from_spec(_SPEC)
+# the script takes the place of this module, so that worker processes
+# started with spawn or forkserver find its functions by importing bsa
+sys.modules[__name__] = _BSA
+_SPEC.loader.exec_module(_BSA)